@@ -1,9 +1,28 @@
+import inspect
 import torch as th
 import torch.nn as nn
 import numpy as np
 import torch.nn.functional as F
-import dgl.function as fn
-from dgl.nn.pytorch.softmax import edge_softmax
+from torch.utils.checkpoint import checkpoint
+try:
+    import dgl.function as fn
+    from dgl.nn.pytorch.softmax import edge_softmax
+except ImportError:
+    # GATNet(backend='torch') runs on an EdgeIndex without DGL
+    fn = edge_softmax = None
+
+# use_reentrant needs torch >= 1.11
+REENTRANT_ONLY = 'use_reentrant' not in inspect.signature(checkpoint).parameters
+
+
+def checkpointed(function, *args):
+    # function(*args) recomputing its activations in backward. The reentrant checkpoint of older torch only
+    # backpropagates into the parameters of function when one of args requires grad, so it runs plainly otherwise
+    if not REENTRANT_ONLY:
+        return checkpoint(function, *args, use_reentrant=False)
+    if any(isinstance(arg, th.Tensor) and arg.requires_grad for arg in args):
+        return checkpoint(function, *args)
+    return function(*args)
 
 
 class Identity(nn.Module):
@@ -14,8 +33,87 @@ class Identity(nn.Module):
         return x
 
 
+class EdgeIndex(object):
+    """
+    Edges src -> dst of a graph with num_nodes nodes as index tensors, for the torch backend of GATNet.
+    edata holds the edge relation ids 'rel' or embeddings 'emb' in edge order, as in the DGL graph.
+    The edges of dst_chunks are the in-edges of nodes dst_start.. dst_start+num_nodes only, their dst counted
+    from dst_start and their src from 0.
+    """
+    def __init__(self, src, dst, num_nodes, edata=None, dst_start=0):
+        self.src = src
+        self.dst = dst
+        self.num_nodes = num_nodes
+        self.edata = edata if edata is not None else {}
+        self.dst_start = dst_start
+        self._csr = None
+
+    @classmethod
+    def from_dgl(cls, graph):
+        src, dst = graph.edges()
+        return cls(src, dst, graph.num_nodes(), {k: graph.edata[k] for k in graph.edata.keys()})
+
+    def to(self, device):
+        return EdgeIndex(self.src.to(device), self.dst.to(device), self.num_nodes,
+                         {k: v.to(device) for k, v in self.edata.items()}, self.dst_start)
+
+    def dst_chunks(self, chunk_size):
+        # the in-edges of chunk_size nodes at a time
+        indptr, _, order = self.csr()
+        chunks = []
+        for start in range(0, self.num_nodes, chunk_size):
+            end = min(start + chunk_size, self.num_nodes)
+            eids = order[indptr[start]:indptr[end]]
+            chunks.append(EdgeIndex(self.src[eids], self.dst[eids] - start, end - start,
+                                    {k: v[eids] for k, v in self.edata.items()}, self.dst_start + start))
+        return chunks
+
+    def u_add_v(self, u, v):
+        return u[self.src] + v[self.dst_start + self.dst]
+
+    def edge_softmax(self, e):
+        # softmax of e over the in-edges of every node
+        if hasattr(e, 'scatter_reduce'):
+            index = self.dst.view(-1, *[1] * (e.dim() - 1)).expand_as(e)
+            shift = e.new_full((self.num_nodes,) + e.shape[1:], float('-inf'))
+            shift = shift.scatter_reduce(0, index, e.detach(), 'amax')[self.dst]
+        else:
+            # no scatter_reduce before torch 1.12: the maxima of the rows of csr, in numpy
+            indptr, _, order = self.csr()
+            nodes = th.nonzero(indptr[1:] > indptr[:-1]).view(-1)
+            shift = e.new_zeros((self.num_nodes,) + e.shape[1:])
+            if len(nodes):
+                maxima = np.maximum.reduceat(e.detach()[order].cpu().numpy(), indptr[nodes].cpu().numpy(), axis=0)
+                shift[nodes] = th.from_numpy(maxima).to(e)
+            shift = shift[self.dst]
+        e = th.exp(e - shift)
+        return e / e.new_zeros((self.num_nodes,) + e.shape[1:]).index_add_(0, self.dst, e)[self.dst]
+
+    def csr(self):
+        # rows of the in-edges of every node, and the edge order sorting them by dst
+        if self._csr is None:
+            # stable: ties broken by edge id, th.sort has no stable before torch 1.9
+            order = th.argsort(self.dst.long() * len(self.dst) + th.arange(len(self.dst), device=self.dst.device))
+            indptr = self.dst.new_zeros(self.num_nodes + 1)
+            indptr[1:] = th.bincount(self.dst, minlength=self.num_nodes).cumsum(0)
+            self._csr = indptr, self.src[order], order
+        return self._csr
+
+    def propagate(self, features, w):
+        # sum of w * features[src] into dst, update_all(fn.u_mul_e, fn.sum), for (N, num_heads, d) features
+        # and (E, num_heads, 1) weights
+        if not (features.requires_grad or w.requires_grad) and hasattr(th, 'sparse_csr_tensor'):
+            # inference: a CSR sparse product per head, without the (E, num_heads, d) messages
+            indptr, col, order = self.csr()
+            w = w[order]
+            return th.stack([th.sparse_csr_tensor(indptr, col, w[:, h, 0], (self.num_nodes, len(features)))
+                             @ features[:, h] for h in range(features.shape[1])], dim=1)
+        return features.new_zeros((self.num_nodes,) + features.shape[1:]).index_add_(0, self.dst, features[self.src] * w)
+
+
 class SingleHeadGATLayer(nn.Module):
-    def __init__(self, in_dim, out_dim, k, alpha, activation=F.elu, layer_norm=False, batch_norm=False, residual=False, dropout=0):
+    def __init__(self, in_dim, out_dim, k, alpha, activation=F.elu, layer_norm=False, batch_norm=False, residual=False, dropout=0,
+                 attention_once=False):
         super(SingleHeadGATLayer, self).__init__()
         #self.fc = nn.Linear(in_dim, out_dim, bias=True)
         self.attn_fc = nn.Linear(3 * out_dim, 1, bias=True)
@@ -40,6 +138,8 @@ class SingleHeadGATLayer(nn.Module):
         TEMP[-1] = (1-alpha)**k
         self.temp = nn.Parameter(th.tensor(TEMP))
         self.dropout = nn.Dropout(dropout)
+        # attention of the layer input reused by all k steps, which then are sparse products with one matrix
+        self.attention_once = attention_once
         self.reset_parameters()
 
     def reset_parameters(self):
@@ -55,11 +155,26 @@ class SingleHeadGATLayer(nn.Module):
         self.temp.data[-1] = (1-self._alpha)**self._k
 
     def edge_attention(self, edges):
+        # reference form of attention, builds [src, emb, dst] for every edge
         z2 = th.cat([edges.src['feat'], edges.data['emb'], edges.dst['feat']], dim=1)
         a = self.attn_fc(z2)
         return {'e': F.leaky_relu(a)}
-  
-    def forward(self, graph, features):
+
+    def attention(self, graph, features, rel_emb=None):
+        # edge_attention without the per-edge concatenation: attn_fc is linear, so its src and dst terms are
+        # computed per node and added along the edges, its emb term per relation of rel_emb gathered by
+        # edata['rel'], or per edge from edata['emb'] without rel_emb
+        w_src, w_emb, w_dst = self.attn_fc.weight.split(features.shape[-1], dim=1)
+        graph.ndata['a_src'] = features @ w_src.t()
+        graph.ndata['a_dst'] = features @ w_dst.t()
+        graph.apply_edges(fn.u_add_v('a_src', 'a_dst', 'e'))
+        if rel_emb is not None:
+            a_emb = (rel_emb @ w_emb.t())[graph.edata['rel']]
+        else:
+            a_emb = graph.edata['emb'] @ w_emb.t()
+        return F.leaky_relu(graph.edata.pop('e') + a_emb + self.attn_fc.bias)
+
+    def forward(self, graph, features, rel_emb=None):
         #g = graph.local_var()
       with graph.local_scope():
         if self.layer_norm:
@@ -67,12 +182,14 @@ class SingleHeadGATLayer(nn.Module):
         else:
           h_tide = features
         features_two = features * self.temp[0]
+        if self.attention_once:
+          graph.edata['w'] = self.dropout(edge_softmax(graph, self.attention(graph, features, rel_emb)))
         for k in range(self._k):
           
           graph.ndata['feat'] = features
-          graph.apply_edges(self.edge_attention)
-          e = graph.edata.pop('e')
-          graph.edata['w'] = self.dropout(edge_softmax(graph,e))
+          if not self.attention_once:
+            e = self.attention(graph, features, rel_emb)
+            graph.edata['w'] = self.dropout(edge_softmax(graph,e))
           
           graph.update_all(fn.u_mul_e('feat', 'w', 'm'), fn.sum('m', 'h'))
           features = graph.ndata.pop('h')
@@ -89,60 +206,146 @@ class SingleHeadGATLayer(nn.Module):
 
 
 class GATLayer(nn.Module):
+    """
+    num_heads SingleHeadGATLayer diffusions run together: the heads' attention parameters are stacked, and
+    every diffusion step computes the (E, num_heads) attention and the messages of all heads in one edge pass.
+    Heads are merged by Wo over their concatenation or by their mean. The activation, batch norm and residual
+    of SingleHeadGATLayer never reach its output, so they are not built. Checkpoints of the per-head layer
+    load through _load_from_state_dict. With attention_once the attention of the layer input is reused by
+    every step, as in SingleHeadGATLayer. The graph is a DGL graph or an EdgeIndex.
+    """
     def __init__(self, in_dim, out_dim, k, alpha, num_heads, merge='cat', activation=F.elu,
-                 batch_norm=False, residual=False, dropout=0):
+                 batch_norm=False, residual=False, dropout=0, attention_once=False):
         super(GATLayer, self).__init__()
-        self.heads = nn.ModuleList()
+        self._k = k
+        self._alpha = alpha
+        self.num_heads = num_heads
+        self.attn_weight = nn.Parameter(th.empty(num_heads, 3 * out_dim))
+        self.attn_bias = nn.Parameter(th.empty(num_heads))
+        self.temp = nn.Parameter(th.empty(num_heads, k + 1))
         self.Wo = nn.Linear(num_heads*out_dim, out_dim, bias=True)
-    #   self.W1 = nn.Linear(out_dim, out_dim, bias=False)
-    #   self.W2 = nn.Linear(out_dim, out_dim, bias=False)
-        self.norm = nn.LayerNorm(out_dim)
-        #self.act = nn.ReLU()
-        layer_norm = False
-        
-        for i in range(num_heads):
-            self.heads.append(SingleHeadGATLayer(in_dim, out_dim, k,
-              alpha, activation, layer_norm, batch_norm, residual, dropout))
+        self.dropout = nn.Dropout(dropout)
         self.merge = merge
-        #self.reset_parameters()
-        
+        self.attention_once = attention_once
+        self.reset_heads()
+
+    def reset_heads(self):
+        # the initialization of num_heads separate SingleHeadGATLayer
+        gain = nn.init.calculate_gain("relu")
+        fan_in = self.attn_weight.shape[1]
+        nn.init.normal_(self.attn_weight, std=gain * np.sqrt(2. / (fan_in + 1)))
+        nn.init.uniform_(self.attn_bias, -1. / np.sqrt(fan_in), 1. / np.sqrt(fan_in))
+        temp = self._alpha*(1-self._alpha)**np.arange(self._k+1)
+        temp[-1] = (1-self._alpha)**self._k
+        self.temp.data.copy_(th.tensor(temp).expand_as(self.temp))
+
     def reset_parameters(self):
         gain = nn.init.calculate_gain("relu")
         nn.init.xavier_normal_(self.Wo.weight, gain=gain)
-        #nn.init.xavier_normal_(self.W1.weight, gain=gain)
-        #nn.init.xavier_normal_(self.W2.weight, gain=gain)
-        
-    def forward(self, g, features):
-        head_outs = [attn_head(g, features) for attn_head in self.heads]
-        if self.merge == 'cat':
-            h_hat = self.Wo(th.cat(head_outs, dim=1))
-            #h_hat = h_hat + features
-            #return th.cat(head_outs, dim=1)
-            
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # per-head checkpoints: heads.{i}.attn_fc and heads.{i}.temp are stacked, the unused norm dropped
+        if prefix + 'heads.0.attn_fc.weight' in state_dict:
+            heads = range(self.num_heads)
+            state_dict[prefix + 'attn_weight'] = th.cat([state_dict[prefix + 'heads.%d.attn_fc.weight' % i] for i in heads])
+            state_dict[prefix + 'attn_bias'] = th.cat([state_dict[prefix + 'heads.%d.attn_fc.bias' % i] for i in heads])
+            state_dict[prefix + 'temp'] = th.stack([state_dict[prefix + 'heads.%d.temp' % i] for i in heads]).float()
+            for key in [key for key in state_dict if key.startswith((prefix + 'heads.', prefix + 'norm.'))]:
+                del state_dict[key]
+        super(GATLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def attention(self, g, features, rel_emb=None):
+        # (E, num_heads) logits of attn_fc over [src, emb, dst] from node and relation terms, as in
+        # SingleHeadGATLayer.attention
+        return self.edge_logits(g, *self.node_logits(features), rel_emb=rel_emb)
+
+    def node_logits(self, features):
+        w_src, _, w_dst = self.attn_weight.chunk(3, dim=1)
+        return th.einsum('nhd,hd->nh', features, w_src), th.einsum('nhd,hd->nh', features, w_dst)
+
+    def edge_logits(self, g, a_src, a_dst, rel_emb=None):
+        _, w_emb, _ = self.attn_weight.chunk(3, dim=1)
+        if isinstance(g, EdgeIndex):
+            e = g.u_add_v(a_src, a_dst)
+        else:
+            with g.local_scope():
+                g.ndata['a_src'] = a_src
+                g.ndata['a_dst'] = a_dst
+                g.apply_edges(fn.u_add_v('a_src', 'a_dst', 'e'))
+                e = g.edata['e']
+        if rel_emb is not None:
+            a_emb = (rel_emb @ w_emb.t())[g.edata['rel']]
         else:
-            #return th.mean(th.stack(head_outs), dim=0)
-            h_hat = th.mean(th.stack(head_outs), dim=0) #+ features
-        #variable = self.act(self.W1(self.norm(h_hat)))
-        #variable = self.W2(variable)
-        #h_prm = h_hat + variable
-        return h_hat#h_prm
-            
-            
+            a_emb = g.edata['emb'] @ w_emb.t()
+        return F.leaky_relu(e + a_emb + self.attn_bias)
+
+    def edge_weights(self, g, features, rel_emb=None):
+        e = self.attention(g, features, rel_emb)
+        w = g.edge_softmax(e) if isinstance(g, EdgeIndex) else edge_softmax(g, e)
+        return self.dropout(w).unsqueeze(-1)
+
+    def propagate(self, g, features, w):
+        if isinstance(g, EdgeIndex):
+            return g.propagate(features, w)
+        with g.local_scope():
+            g.ndata['feat'] = features
+            g.edata['w'] = w
+            g.update_all(fn.u_mul_e('feat', 'w', 'm'), fn.sum('m', 'h'))
+            return g.ndata['h']
+
+    def forward(self, g, features, rel_emb=None):
+        # features of every head are (N, num_heads, out_dim), diffused with their own attention
+        features = features.unsqueeze(1).expand(-1, self.num_heads, -1)
+        features_two = features * self.temp[:, 0:1]
+        if self.attention_once:
+            w = self.edge_weights(g, features, rel_emb)
+        for k in range(self._k):
+            if not self.attention_once:
+                w = self.edge_weights(g, features, rel_emb)
+            features = self.propagate(g, features, w)
+            features_two = features_two + self.temp[:, k+1:k+2] * features
+        return self.merge_heads(features_two)
+
+    def merge_heads(self, features):
+        if self.merge == 'cat':
+            return self.Wo(features.reshape(len(features), -1))
+        return features.mean(1)
+
+    def forward_chunked(self, chunks, features, rel_emb=None):
+        # forward over the dst_chunks of an EdgeIndex, bounding the messages of a step to those of a chunk.
+        # the node terms of the attention are computed once per step for all chunks
+        features = features.unsqueeze(1).expand(-1, self.num_heads, -1)
+        features_two = features * self.temp[:, 0:1]
+        for k in range(self._k):
+            if k == 0 or not self.attention_once:
+                a_src, a_dst = self.node_logits(features)
+                ws = [self.dropout(c.edge_softmax(self.edge_logits(c, a_src, a_dst, rel_emb))).unsqueeze(-1)
+                      for c in chunks]
+            features = th.cat([c.propagate(features, w) for c, w in zip(chunks, ws)])
+            features_two = features_two + self.temp[:, k+1:k+2] * features
+        return self.merge_heads(features_two)
+
 
 class GATNet(nn.Module):
     def __init__(self, num_feats, num_rels, num_hidden, num_classes, num_layers, k, alpha, num_heads, merge='cat',
-                 activation=F.elu, batch_norm=False, residual=False, dropout=0.5):
+                 activation=F.elu, batch_norm=False, residual=False, dropout=0.5, attention_once=False, backend='dgl',
+                 checkpoint=False):
         super(GATNet, self).__init__()
         self.num_layers = num_layers
+        # 'torch' runs the layers on an EdgeIndex with index_add_ instead of DGL message passing. GATNet then
+        # needs no DGL, though a DGL graph given to forward is converted on every call
+        self.backend = backend
+        # recompute the activations of every layer in backward instead of keeping them
+        self.checkpoint = checkpoint
         #self.s = nn.Parameter(th.FloatTensor(num_classes,1))
         self.layers = nn.ModuleList()
         self.layers.append(GATLayer(num_feats, num_hidden, k, alpha, num_heads, merge,
-                                    activation, batch_norm, residual, dropout))
+                                    activation, batch_norm, residual, dropout, attention_once))
         for i in range(1, num_layers-1):
             self.layers.append(GATLayer(num_hidden, num_hidden, k, alpha, num_heads, merge,
-                                    activation, batch_norm, residual, dropout))
+                                    activation, batch_norm, residual, dropout, attention_once))
         self.layers.append(GATLayer(num_hidden, num_classes, k, alpha, num_heads, merge,
-                                    activation, batch_norm, residual, dropout))
+                                    activation, batch_norm, residual, dropout, attention_once))
 
         self.reset_parameters()
         
@@ -150,9 +353,30 @@ class GATNet(nn.Module):
         gain = nn.init.calculate_gain('sigmoid')
         #nn.init.xavier_uniform_(self.s, gain=gain)
 
-    def forward(self, graph, features):
+    def forward(self, graph, features, rel_emb=None):
+        # edges carry their embedding as edata['emb'], or as rows edata['rel'] of rel_emb
         h = features
-        graph = graph.local_var()
+        if self.backend == 'torch':
+            if not isinstance(graph, EdgeIndex):
+                graph = EdgeIndex.from_dgl(graph)
+        else:
+            graph = graph.local_var()
         for i, layer in enumerate(self.layers):
-            h = layer(graph, h)
-        return h
\ No newline at end of file
+            if self.checkpoint and th.is_grad_enabled():
+                h = checkpointed(layer, graph, h, rel_emb)
+            else:
+                h = layer(graph, h, rel_emb)
+        return h
+
+    def forward_chunked(self, graph, features, rel_emb=None, chunk_size=65536):
+        """
+        forward over a whole graph, a DGL graph or an EdgeIndex, layer by layer and diffusion step by step,
+        each step over the in-edges of chunk_size nodes at a time
+        """
+        if not isinstance(graph, EdgeIndex):
+            graph = EdgeIndex.from_dgl(graph).to(features.device)
+        chunks = graph.dst_chunks(chunk_size)
+        h = features
+        for layer in self.layers:
+            h = layer.forward_chunked(chunks, h, rel_emb)
+        return h
@@ -0,0 +1,371 @@
+"""
+Micro benchmarks of the graph pipeline on synthetic data, e.g.
+    python benchmarks.py adjacency --num_facts 1000000 --num_rels 500
+    python benchmarks.py gat_heads --num_nodes 20000 --num_edges 200000
+    python benchmarks.py attention --num_nodes 20000 --num_edges 200000 --num_rels 500
+    python benchmarks.py attention_once --num_nodes 20000 --num_edges 200000 --k 3
+    python benchmarks.py gat_backend --num_nodes 20000 --num_edges 200000 --num_rels 500
+    python benchmarks.py whole_graph --num_nodes 20000 --num_edges 200000 --num_questions 500 --khop 2
+    python benchmarks.py checkpoint --num_nodes 20000 --num_edges 200000 --batch_size 150
+    python benchmarks.py topk_scoring --num_nodes 125000 --batch_size 150 --chunk_size 8192
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import dgl
+from scipy.sparse import csc_matrix
+from torch import nn
+
+from construct_graph import typed_adjacency
+from attention_diffusion import SingleHeadGATLayer, GATLayer, GATNet, EdgeIndex
+from subgraphs import graph_csr
+
+
+def synthetic_triplets(num_facts, num_nodes, num_rels, seed=0):
+    rng = np.random.default_rng(seed)
+    # skewed relation frequencies like a real TKG
+    rel_p = 1. / np.arange(1, num_rels + 1)
+    rel = rng.choice(num_rels, num_facts, p=rel_p / rel_p.sum())
+    return np.stack([rng.integers(num_nodes, size=num_facts), rel, rng.integers(num_nodes, size=num_facts)], axis=1)
+
+
+def timed(fn, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def adjacency_loop(tripts, num_rels, num_nodes):
+    # per-relation argwhere over the full triple array, as construct_triplet used to do
+    adj_list = []
+    for i in range(num_rels):
+        idx = np.argwhere(tripts[:, 1] == i)
+        adj_list.append(csc_matrix((np.ones(len(idx), dtype=np.uint8), (tripts[:, 0][idx].squeeze(1),
+                                    tripts[:, 2][idx].squeeze(1))), shape=(num_nodes, num_nodes)))
+    adj_list += [adj.T for adj in adj_list]
+    return adj_list
+
+
+def bench_adjacency(args):
+    tripts = synthetic_triplets(args.num_facts, args.num_nodes, args.num_rels)
+    loop_time, adj_list = timed(adjacency_loop, tripts, args.num_rels, args.num_nodes)
+    csr_time, (rel_ptr, src, dst) = timed(typed_adjacency, tripts, args.num_rels, args.num_nodes, True)
+    for r in range(0, 2 * args.num_rels, max(1, args.num_rels // 10)):
+        coo = adj_list[r].tocoo()
+        expected = np.unique(np.stack([coo.row, coo.col], axis=1), axis=0)
+        got = np.stack([src[rel_ptr[r]:rel_ptr[r + 1]], dst[rel_ptr[r]:rel_ptr[r + 1]]], axis=1)
+        assert np.array_equal(expected, got), 'adjacency of relation %d differs' % r
+    print('%d facts, %d relations, %d nodes' % (args.num_facts, args.num_rels, args.num_nodes))
+    print('argwhere loop   %8.3fs' % loop_time)
+    print('typed CSR       %8.3fs  (%.1fx)' % (csr_time, loop_time / csr_time))
+
+
+class PerHeadGATLayer(nn.Module):
+    # the GATLayer before its heads were fused, one SingleHeadGATLayer message passing per head
+    def __init__(self, in_dim, out_dim, k, alpha, num_heads, merge='cat', dropout=0):
+        super(PerHeadGATLayer, self).__init__()
+        self.heads = nn.ModuleList([SingleHeadGATLayer(in_dim, out_dim, k, alpha, dropout=dropout)
+                                    for _ in range(num_heads)])
+        self.Wo = nn.Linear(num_heads*out_dim, out_dim, bias=True)
+        self.norm = nn.LayerNorm(out_dim)
+        self.merge = merge
+
+    def forward(self, g, features):
+        head_outs = [attn_head(g, features) for attn_head in self.heads]
+        if self.merge == 'cat':
+            return self.Wo(torch.cat(head_outs, dim=1))
+        return torch.mean(torch.stack(head_outs), dim=0)
+
+
+def synthetic_graph(num_nodes, num_edges, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    g = dgl.graph((torch.from_numpy(rng.integers(num_nodes, size=num_edges)),
+                   torch.from_numpy(rng.integers(num_nodes, size=num_edges))), num_nodes=num_nodes)
+    g.edata['emb'] = torch.randn(num_edges, dim)
+    return g, torch.randn(num_nodes, dim)
+
+
+def forward_backward(layer, g, features):
+    out = layer(g, features)
+    out.sum().backward()
+    return out.detach()
+
+
+def bench_gat_heads(args):
+    g, features = synthetic_graph(args.num_nodes, args.num_edges, args.dim)
+    features.requires_grad_()
+    for merge in ('mean', 'cat'):
+        per_head = PerHeadGATLayer(args.dim, args.dim, args.k, 0.5, args.num_heads, merge).eval()
+        fused = GATLayer(args.dim, args.dim, args.k, 0.5, args.num_heads, merge).eval()
+        # per-head checkpoints load into the fused layer
+        fused.load_state_dict(per_head.state_dict())
+        per_head_time, expected = timed(forward_backward, per_head, g, features)
+        fused_time, got = timed(forward_backward, fused, g, features)
+        assert torch.allclose(expected, got, rtol=1e-4, atol=1e-5), 'fused %s merge differs' % merge
+        print('%d nodes, %d edges, %d heads, k=%d, %s merge, %d threads' % (
+            args.num_nodes, args.num_edges, args.num_heads, args.k, merge, torch.get_num_threads()))
+        print('per-head layer  %8.3fs' % per_head_time)
+        print('fused heads     %8.3fs  (%.1fx)' % (fused_time, per_head_time / fused_time))
+
+
+def concat_logits(layer, g, features):
+    # SingleHeadGATLayer.edge_attention on edata['emb']
+    with g.local_scope():
+        g.ndata['feat'] = features
+        g.apply_edges(layer.edge_attention)
+        return g.edata['e']
+
+
+def decomposed_logits(layer, g, features, rel_emb=None):
+    with g.local_scope():
+        return layer.attention(g, features, rel_emb)
+
+
+def logits_backward(fn, *args):
+    out = fn(*args)
+    out.sum().backward()
+    return out.detach()
+
+
+def bench_attention(args):
+    g, features = synthetic_graph(args.num_nodes, args.num_edges, args.dim)
+    rel_emb = torch.randn(args.num_rels, args.dim)
+    g.edata['rel'] = torch.from_numpy(np.random.default_rng(1).integers(args.num_rels, size=args.num_edges))
+    g.edata['emb'] = rel_emb[g.edata['rel']]
+    features.requires_grad_()
+    layer = SingleHeadGATLayer(args.dim, args.dim, args.k, 0.5)
+    concat_time, _ = timed(logits_backward, concat_logits, layer, g, features)
+    emb_time, _ = timed(logits_backward, decomposed_logits, layer, g, features)
+    rel_time, _ = timed(logits_backward, decomposed_logits, layer, g, features, rel_emb)
+    # their equality is checked by test_attention_diffusion.py
+
+    print('%d nodes, %d edges, %d relations, dim %d' % (args.num_nodes, args.num_edges, args.num_rels, args.dim))
+    print('concatenated [src, emb, dst]     %8.3fs  %6.1f MB per edge tensor' % (
+        concat_time, 4. * 3 * args.dim * args.num_edges / 2 ** 20))
+    print('node terms + edge emb term       %8.3fs  (%.1fx)  %6.1f MB' % (
+        emb_time, concat_time / emb_time, 4. * args.num_edges / 2 ** 20))
+    print('node terms + relation term       %8.3fs  (%.1fx)  %6.1f MB' % (
+        rel_time, concat_time / rel_time, 4. * args.num_edges / 2 ** 20))
+
+
+def bench_attention_once(args):
+    g, features = synthetic_graph(args.num_nodes, args.num_edges, args.dim)
+    features.requires_grad_()
+    # one diffusion step attends to the layer input in both modes
+    per_step = GATLayer(args.dim, args.dim, 1, 0.5, args.num_heads).eval()
+    once = GATLayer(args.dim, args.dim, 1, 0.5, args.num_heads, attention_once=True).eval()
+    once.load_state_dict(per_step.state_dict())
+    assert torch.allclose(per_step(g, features), once(g, features), rtol=1e-4, atol=1e-5)
+
+    per_step = GATNet(args.dim, 0, args.dim, args.dim, 3, args.k, 0.5, args.num_heads, merge='mean').eval()
+    once = GATNet(args.dim, 0, args.dim, args.dim, 3, args.k, 0.5, args.num_heads, merge='mean',
+                  attention_once=True).eval()
+    once.load_state_dict(per_step.state_dict())
+    per_step_time, expected = timed(forward_backward, per_step, g, features)
+    once_time, got = timed(forward_backward, once, g, features)
+    # how far reusing the first step's attention moves the output of the same weights, untrained; the effect on
+    # QA accuracy needs a model trained in each mode
+    error = (got - expected).norm(dim=1) / expected.norm(dim=1).clamp(min=1e-12)
+    cosine = torch.cosine_similarity(got, expected, dim=1)
+    print('%d nodes, %d edges, %d heads, k=%d, 3 layers' % (args.num_nodes, args.num_edges, args.num_heads, args.k))
+    print('attention per step   %8.3fs' % per_step_time)
+    print('attention once       %8.3fs  (%.1fx)' % (once_time, per_step_time / once_time))
+    print('relative error  mean %.4f  max %.4f' % (error.mean(), error.max()))
+    print('cosine          mean %.4f  min %.4f' % (cosine.mean(), cosine.min()))
+
+
+def inference(net, g, features, rel_emb):
+    with torch.no_grad():
+        return net(g, features, rel_emb)
+
+
+def bench_gat_backend(args):
+    g, features = synthetic_graph(args.num_nodes, args.num_edges, args.dim)
+    rel_emb = torch.randn(args.num_rels, args.dim)
+    g.edata['rel'] = torch.from_numpy(np.random.default_rng(1).integers(args.num_rels, size=args.num_edges))
+    edges = EdgeIndex.from_dgl(g)
+    print('%d nodes, %d edges, %d heads, k=%d, 3 layers, %d threads' % (
+        args.num_nodes, args.num_edges, args.num_heads, args.k, torch.get_num_threads()))
+    for once in (False, True):
+        dgl_net = GATNet(args.dim, 0, args.dim, args.dim, 3, args.k, 0.5, args.num_heads, merge='mean',
+                         attention_once=once).eval()
+        torch_net = GATNet(args.dim, 0, args.dim, args.dim, 3, args.k, 0.5, args.num_heads, merge='mean',
+                           attention_once=once, backend='torch').eval()
+        torch_net.load_state_dict(dgl_net.state_dict())
+        dgl_time, expected = timed(inference, dgl_net, g, features, rel_emb)
+        torch_time, got = timed(inference, torch_net, edges, features, rel_emb)
+        assert torch.allclose(expected, got, rtol=1e-4, atol=1e-5), 'torch backend differs'
+        assert torch.allclose(dgl_net(g, features), torch_net(edges, features), rtol=1e-4, atol=1e-5)
+        print('%-18s  dgl %8.3fs  torch %8.3fs  (%.1fx)' % ('attention once' if once else 'attention per step',
+                                                          dgl_time, torch_time, dgl_time / torch_time))
+
+
+def per_subgraph_gat(net, csr, seeds, khop, features, rel_emb, batch_size=50):
+    # the GAT over the batched k-hop subgraphs of every question, as QA_Sub.encode_subgraphs
+    out = []
+    with torch.no_grad():
+        for i in range(0, len(seeds), batch_size):
+            graphs = []
+            for e in seeds[i:i + batch_size]:
+                nodes = csr.khop_nodes([e], khop)
+                graphs.append(csr.subgraph(nodes, csr.induced_edges(nodes)))
+            g = dgl.batch(graphs)
+            out.append(net(g, features[g.ndata[dgl.NID]], rel_emb))
+    return torch.cat(out)
+
+
+def whole_graph_gat(net, g, features, rel_emb, chunk_size, seeds, csr, khop):
+    with torch.no_grad():
+        h = net.forward_chunked(g, features, rel_emb, chunk_size)
+        return torch.cat([h[torch.from_numpy(csr.khop_nodes([e], khop))] for e in seeds])
+
+
+def bench_whole_graph(args):
+    g, features = synthetic_graph(args.num_nodes, args.num_edges, args.dim)
+    del g.edata['emb']
+    rel_emb = torch.randn(args.num_rels, args.dim)
+    g.edata['rel'] = torch.from_numpy(np.random.default_rng(1).integers(args.num_rels, size=args.num_edges))
+    net = GATNet(args.dim, 0, args.dim, args.dim, 3, args.k, 0.5, args.num_heads, merge='mean').eval()
+    with torch.no_grad():
+        expected = net(g, features, rel_emb)
+        for chunk_size in (args.num_nodes, args.chunk_size):
+            got = net.forward_chunked(g, features, rel_emb, chunk_size)
+            assert torch.allclose(expected, got, rtol=1e-4, atol=1e-5), 'chunk size %d differs' % chunk_size
+
+    csr = graph_csr(g)
+    seeds = np.random.default_rng(2).choice(args.num_nodes, args.num_questions)
+    subgraph_time, per_subgraph = timed(per_subgraph_gat, net, csr, seeds, args.khop, features, rel_emb, repeat=1)
+    whole_time, whole = timed(whole_graph_gat, net, g, features, rel_emb, args.chunk_size, seeds, csr, args.khop,
+                              repeat=1)
+    # subgraph nodes see only their k-hop neighbourhood, whole-graph nodes their full receptive field
+    cosine = torch.cosine_similarity(per_subgraph, whole, dim=1)
+    print('%d nodes, %d edges, %d questions, khop %d, %d subgraph nodes' % (
+        args.num_nodes, args.num_edges, args.num_questions, args.khop, len(whole)))
+    print('GAT per question subgraph  %8.3fs' % subgraph_time)
+    print('whole graph once           %8.3fs  (%.1fx)' % (whole_time, subgraph_time / whole_time))
+    print('node cosine to subgraph    mean %.4f  min %.4f' % (cosine.mean(), cosine.min()))
+
+
+def saved_megabytes(fn, *args):
+    # forward and backward of fn, with the size of the tensors autograd keeps between them. Under activation
+    # checkpointing the kept tensors are the checkpoint inputs, which these hooks do not see. The hooks need
+    # torch >= 1.10, the size is NaN before
+    storages = {}
+
+    def pack(t):
+        storage = t.untyped_storage() if hasattr(t, 'untyped_storage') else t.storage()
+        storages[storage.data_ptr()] = storage.size() * storage.element_size()
+        return t
+    graph = getattr(torch.autograd, 'graph', None)
+    if not hasattr(graph, 'saved_tensors_hooks'):
+        out = fn(*args)
+        out.float().sum().backward()
+        return float('nan')
+    with graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn(*args)
+    out.float().sum().backward()
+    return sum(storages.values()) / 2 ** 20
+
+
+def gradients(fn, params, *args):
+    for p in params:
+        p.grad = None
+    memory = saved_megabytes(fn, *args)
+    return memory, [torch.zeros_like(p) if p.grad is None else p.grad.clone() for p in params]
+
+
+def report_checkpoint(name, plain, checkpointed, params, *args):
+    memory, expected = gradients(plain, params, *args)
+    checkpointed_memory, got = gradients(checkpointed, params, *args)
+    for p, q in zip(expected, got):
+        assert torch.allclose(p, q, rtol=1e-4, atol=1e-5), '%s gradients differ' % name
+    plain_time, _ = timed(saved_megabytes, plain, *args)
+    checkpointed_time, _ = timed(saved_megabytes, checkpointed, *args)
+    print('%-12s kept activations %8.1f MB -> %8.1f MB   forward+backward %7.3fs -> %7.3fs (%.2fx)' % (
+        name, memory, checkpointed_memory, plain_time, checkpointed_time, checkpointed_time / plain_time))
+
+
+def gat_forward(net, g, features, checkpoint):
+    net.checkpoint = checkpoint
+    return net(g, features)
+
+
+def bench_checkpoint(args):
+    from qa_sub import checkpointed_encoder
+    g, features = synthetic_graph(args.num_nodes, args.num_edges, args.dim)
+    features.requires_grad_()
+    net = GATNet(args.dim, 0, args.dim, args.dim, 3, args.k, 0.5, args.num_heads, merge='mean', dropout=0)
+    print('%d nodes, %d edges, %d heads, k=%d, 3 GAT layers; batch %d of %d tokens, 6 transformer layers' % (
+        args.num_nodes, args.num_edges, args.num_heads, args.k, args.batch_size, args.seq_len))
+    report_checkpoint('GATNet', lambda x: gat_forward(net, g, x, False), lambda x: gat_forward(net, g, x, True),
+                      list(net.parameters()) + [features], features)
+
+    encoder = nn.TransformerEncoder(nn.TransformerEncoderLayer(d_model=512, nhead=8, dropout=0), num_layers=6,
+                                    norm=nn.LayerNorm(512))
+    src = torch.randn(args.seq_len, args.batch_size, 512, requires_grad=True)
+    mask = torch.zeros(args.batch_size, args.seq_len, dtype=torch.bool)
+    mask[:, args.seq_len // 2:] = torch.rand(args.batch_size, args.seq_len - args.seq_len // 2) < 0.5
+    report_checkpoint('transformer', lambda x: encoder(x, src_key_padding_mask=mask),
+                      lambda x: checkpointed_encoder(encoder, x, mask), list(encoder.parameters()) + [src], src)
+
+
+def full_topk(queries, entities, k):
+    scores = queries @ entities.t()
+    values, ids = scores.topk(k, dim=1)
+    return values, ids, torch.logsumexp(scores, dim=1)
+
+
+def chunked_topk(queries, entities, k, chunk_size):
+    from qa_sub import streaming_topk
+    chunks = ((start, queries @ entities[start:start + chunk_size].t())
+              for start in range(0, len(entities), chunk_size))
+    return streaming_topk(chunks, k)[:3]
+
+
+def bench_topk_scoring(args):
+    # entity scoring of QA_Sub.score_entity is a (B, rank) x (rank, num_entities) product per direction
+    queries, entities = torch.randn(args.batch_size, 2 * args.dim), torch.randn(args.num_nodes, 2 * args.dim)
+    with torch.no_grad():
+        full_time, (values, ids, lse) = timed(full_topk, queries, entities, 100)
+        chunked_time, (got_values, got_ids, got_lse) = timed(chunked_topk, queries, entities, 100, args.chunk_size)
+    assert torch.allclose(values, got_values) and torch.allclose(lse, got_lse, rtol=1e-5), 'streamed top k differs'
+    assert torch.allclose(torch.gather(queries @ entities.t(), 1, got_ids), got_values)
+    print('%d questions, %d entities, top 100' % (args.batch_size, args.num_nodes))
+    print('full score matrix  %8.3fs  %8.1f MB' % (full_time, 4. * args.batch_size * args.num_nodes / 2 ** 20))
+    print('chunks of %-8d %8.3fs  %8.1f MB' % (args.chunk_size, chunked_time,
+                                              4. * args.batch_size * args.chunk_size / 2 ** 20))
+
+
+BENCHMARKS = {
+    'attention': bench_attention,
+    'attention_once': bench_attention_once,
+    'checkpoint': bench_checkpoint,
+    'adjacency': bench_adjacency,
+    'gat_backend': bench_gat_backend,
+    'gat_heads': bench_gat_heads,
+    'topk_scoring': bench_topk_scoring,
+    'whole_graph': bench_whole_graph,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Graph pipeline benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--num_facts', default=1000000, type=int)
+    parser.add_argument('--num_nodes', default=100000, type=int)
+    parser.add_argument('--num_rels', default=500, type=int)
+    parser.add_argument('--num_edges', default=200000, type=int)
+    parser.add_argument('--dim', default=128, type=int)
+    parser.add_argument('--num_heads', default=2, type=int)
+    parser.add_argument('--k', default=3, type=int)
+    parser.add_argument('--num_questions', default=500, type=int)
+    parser.add_argument('--khop', default=2, type=int)
+    parser.add_argument('--chunk_size', default=4096, type=int)
+    parser.add_argument('--batch_size', default=150, type=int)
+    parser.add_argument('--seq_len', default=20, type=int)
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
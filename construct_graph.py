@@ -1,55 +1,220 @@
-import numpy as np
-import dgl
-import torch
-import networkx as nx
-from scipy.sparse import csc_matrix
-
-
-def multigraph_to_dgl(graph, n_feats=None, rel_feats=None):
-    g_nx = nx.MultiDiGraph()
-    g_nx.add_nodes_from(list(range(graph[0].shape[0])))
-    if rel_feats is not None:
-    # Add edges
-      for rel, adj in enumerate(graph):
-          # Convert adjacency matrix to tuples for nx0
-          nx_triplets = []
-          for src, dst in list(zip(adj.tocoo().row, adj.tocoo().col)):
-              nx_triplets.append((src, dst, {'type': rel, 'emb': rel_feats[rel, :]}))
-          g_nx.add_edges_from(nx_triplets)
-
-      # make dgl graph
-      #g_dgl = dgl.DGLGraph(multigraph=True)
-      g_dgl=dgl.from_networkx(g_nx, edge_attrs=['type', 'emb']) 
-    else:
-      for rel, adj in enumerate(graph):
-        nx_triplets = []
-        for src, dst in list(zip(adj.tocoo().row, adj.tocoo().col)):
-          nx_triplets.append((src, dst, {'type':rel}))
-          g_nx.add_edges_from(nx_triplets)
-      g_dgl = dgl.from_networkx(g_nx, edge_attrs=['type'])
-    if n_feats is not None:
-      g_dgl.ndata['feat'] = torch.tensor(n_feats)
-    
-    return g_dgl
-
-
-def construct_triplet(kg_file, dataset_name, ent2id, rel2id, node_feature, rel_feature, add_transpose_rel):
-  kg_file = f'data/{dataset_name}/kg/'+kg_file
-  triplet = []
-  with open(kg_file) as f:
-    for line in f.readlines():
-      sub, rel, obj, _, _ = line.strip().split("\t")
-      triplet.append([ent2id[sub], rel2id[rel], ent2id[obj]])
-  
-  tripts = np.array(triplet)
-  adj_list = []
-  for i in range(len(rel2id)):
-      idx =  np.argwhere(tripts[:, 1]==i)
-  adj_list.append(csc_matrix((np.ones(len(idx), dtype=np.uint8), (tripts[:, 0][idx].squeeze(1), \
-                    tripts[:, 2][idx].squeeze(1))), shape=(len(ent2id), len(ent2id))))
-  if add_transpose_rel:
-      adj_list_t = [adj.T for adj in adj_list]
-      adj_list += adj_list_t
-  #aug_num_rels = len(adj_list)
-  graph = multigraph_to_dgl(adj_list, node_feature, rel_feature)
-  return graph
\ No newline at end of file
+import os
+import hashlib
+import numpy as np
+import dgl
+import torch
+import networkx as nx
+from scipy.sparse import csc_matrix
+from tkg_index import SUB, REL, OBJ, START, END, budget_rows, file_hash, load_tkg_index
+
+# bump whenever triplets_to_dgl changes the graph it builds
+GRAPH_CACHE_VERSION = 3
+GRAPH_CACHE_DIR = 'saved_pkl/graph_cache'
+
+
+def multigraph_to_dgl(graph, n_feats=None, rel_feats=None):
+    g_nx = nx.MultiDiGraph()
+    g_nx.add_nodes_from(list(range(graph[0].shape[0])))
+    if rel_feats is not None:
+    # Add edges
+      for rel, adj in enumerate(graph):
+          # Convert adjacency matrix to tuples for nx0
+          nx_triplets = []
+          for src, dst in list(zip(adj.tocoo().row, adj.tocoo().col)):
+              nx_triplets.append((src, dst, {'type': rel, 'emb': rel_feats[rel, :]}))
+          g_nx.add_edges_from(nx_triplets)
+
+      # make dgl graph
+      #g_dgl = dgl.DGLGraph(multigraph=True)
+      g_dgl=dgl.from_networkx(g_nx, edge_attrs=['type', 'emb']) 
+    else:
+      for rel, adj in enumerate(graph):
+        nx_triplets = []
+        for src, dst in list(zip(adj.tocoo().row, adj.tocoo().col)):
+          nx_triplets.append((src, dst, {'type':rel}))
+        g_nx.add_edges_from(nx_triplets)
+      g_dgl = dgl.from_networkx(g_nx, edge_attrs=['type'])
+    if n_feats is not None:
+      g_dgl.ndata['feat'] = torch.tensor(n_feats)
+    
+    return g_dgl
+
+
+def typed_adjacency(triplets, num_rels, num_nodes, add_transpose_rel=False, times=None):
+    """
+    Typed CSR adjacency of all relations from one sort on (rel, src, dst): the edges of relation r are
+    src[rel_ptr[r]:rel_ptr[r + 1]] -> dst[rel_ptr[r]:rel_ptr[r + 1]], one per distinct (src, rel, dst).
+    Transposed relation r gets type r + num_rels. Given the (start, end) years of the triplets as
+    times, the earliest start and latest end of each edge's facts are returned as well.
+    """
+    triplets = np.asarray(triplets, dtype=np.int64)
+    src, rel, dst = triplets[:, 0], triplets[:, 1], triplets[:, 2]
+    if add_transpose_rel:
+        src, dst, rel = np.concatenate([src, dst]), np.concatenate([dst, src]), np.concatenate([rel, rel + num_rels])
+        num_rels = 2 * num_rels
+        if times is not None:
+            times = np.concatenate([times, times])
+    if num_rels * num_nodes * num_nodes < 2 ** 63:
+        # (rel, src, dst) packed into one int64 sorts much faster than a lexsort
+        key = (rel * num_nodes + src) * num_nodes + dst
+        order = np.argsort(key, kind='stable') if times is not None else None
+        key = np.sort(key) if order is None else key[order]
+        keep = np.ones(len(key), dtype=bool)
+        keep[1:] = key[1:] != key[:-1]
+        key = key[keep]
+        rel, src, dst = key // (num_nodes * num_nodes), key // num_nodes % num_nodes, key % num_nodes
+    else:
+        order = np.lexsort((dst, src, rel))
+        src, rel, dst = src[order], rel[order], dst[order]
+        keep = np.ones(len(src), dtype=bool)
+        keep[1:] = (src[1:] != src[:-1]) | (rel[1:] != rel[:-1]) | (dst[1:] != dst[:-1])
+        src, rel, dst = src[keep], rel[keep], dst[keep]
+    rel_ptr = np.zeros(num_rels + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rel, minlength=num_rels), out=rel_ptr[1:])
+    if times is None:
+        return rel_ptr, src, dst
+    times = np.asarray(times)[order]
+    groups = np.flatnonzero(keep)
+    return rel_ptr, src, dst, np.minimum.reduceat(times[:, 0], groups), np.maximum.reduceat(times[:, 1], groups)
+
+
+def index_adjacency(index, ent_map, rel_map, num_rels, num_nodes, add_transpose_rel=False, memory_budget=None):
+    """
+    typed_adjacency with times of the facts of a TKG index, from its per-relation fact lists rel_ptr/rel_facts.
+    Relations are processed in groups of about budget_rows(memory_budget) facts, a larger relation alone,
+    so apart from the edges returned memory stays within the budget. ent_map and rel_map take index ids
+    to tkbc ids.
+    """
+    rows = budget_rows(memory_budget)
+    # index relation of every tkbc relation, facts per tkbc relation
+    index_rel = np.full(num_rels, -1, dtype=np.int64)
+    index_rel[rel_map] = np.arange(len(rel_map))
+    counts = np.zeros(num_rels, dtype=np.int64)
+    counts[rel_map] = np.diff(index.rel_ptr)
+    num_types = 2 * num_rels if add_transpose_rel else num_rels
+    edges, sizes = [], []
+    first = 0
+    while first < num_types:
+        last, total = first + 1, counts[first % num_rels]
+        while last < num_types and total + counts[last % num_rels] <= rows:
+            total += counts[last % num_rels]
+            last += 1
+        types = np.arange(first, last)
+        ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            index.rel_facts[index.rel_ptr[index_rel[r]]:index.rel_ptr[index_rel[r] + 1]]
+            for r in types % num_rels if index_rel[r] >= 0])
+        facts = index.facts[ids]
+        src, dst = ent_map[facts[:, SUB]], ent_map[facts[:, OBJ]]
+        # transposed relations r + num_rels hold the facts of r reversed
+        reverse = np.repeat(types >= num_rels, counts[types % num_rels])
+        src, dst = np.where(reverse, dst, src), np.where(reverse, src, dst)
+        triplets = np.stack([src, np.repeat(types - first, counts[types % num_rels]), dst], axis=1)
+        rel_ptr, src, dst, start, end = typed_adjacency(triplets, last - first, num_nodes,
+                                                        times=facts[:, [START, END]])
+        edges.append((src, dst, start, end))
+        sizes.append(np.diff(rel_ptr))
+        first = last
+    rel_ptr = np.zeros(num_types + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(sizes), out=rel_ptr[1:])
+    return (rel_ptr,) + tuple(np.concatenate(column) for column in zip(*edges))
+
+
+def triplets_to_dgl(triplets, num_nodes, num_rels, n_feats=None, add_transpose_rel=False, times=None):
+    # edges of the typed adjacency in one dgl.graph call. Edges only carry the relation id,
+    # the model looks up the relation embeddings itself, and the years their facts span if times are given
+    return adjacency_to_dgl(typed_adjacency(triplets, num_rels, num_nodes, add_transpose_rel, times), num_nodes,
+                            n_feats)
+
+
+def adjacency_to_dgl(adjacency, num_nodes, n_feats=None):
+    # graph of the (rel_ptr, src, dst[, start, end]) of typed_adjacency or index_adjacency
+    rel_ptr, src, dst = adjacency[:3]
+    g_dgl = dgl.graph((torch.from_numpy(src), torch.from_numpy(dst)), num_nodes=num_nodes)
+    g_dgl.edata['type'] = torch.from_numpy(np.repeat(np.arange(len(rel_ptr) - 1), np.diff(rel_ptr)))
+    if len(adjacency) > 3:
+        g_dgl.edata['start'] = torch.from_numpy(adjacency[3])
+        g_dgl.edata['end'] = torch.from_numpy(adjacency[4])
+    if n_feats is not None:
+        g_dgl.ndata['feat'] = torch.tensor(n_feats)
+    return g_dgl
+
+
+def graph_cache_path(kg_file, ent2id, rel2id, add_transpose_rel, cache_dir=GRAPH_CACHE_DIR):
+    # the graph depends on the TKG contents, the tkbc id mappings and the transposed relations
+    h = hashlib.sha1()
+    h.update(('%s %d %s\n' % (file_hash(kg_file), GRAPH_CACHE_VERSION, add_transpose_rel)).encode())
+    for mapping in (ent2id, rel2id):
+        h.update(''.join('%s\t%d\n' % item for item in sorted(mapping.items())).encode())
+    return os.path.join(cache_dir, '%s-%s.bin' % (os.path.basename(kg_file), h.hexdigest()[:16]))
+
+
+_graphs = {}
+
+
+def construct_triplet(kg_file, dataset_name, ent2id, rel2id, node_feature, add_transpose_rel, use_networkx=False):
+  kg_file = f'data/{dataset_name}/kg/'+kg_file
+  if use_networkx:
+    return construct_triplet_networkx(kg_file, ent2id, rel2id, node_feature, add_transpose_rel)
+
+  # built once per process and saved with dgl.save_graphs for later runs. Node features come from the
+  # tkbc checkpoint rather than the TKG, so they are attached after loading instead of being cached
+  path = graph_cache_path(kg_file, ent2id, rel2id, add_transpose_rel)
+  if path not in _graphs:
+    if os.path.exists(path):
+      print('Loading graph from', path)
+      graph = dgl.load_graphs(path)[0][0]
+    else:
+      # from the per-relation fact lists of the memory mapped index, under the memory budget
+      index = load_tkg_index(kg_file)
+      ent_map, rel_map = tkbc_maps(index, ent2id, rel2id)
+      graph = adjacency_to_dgl(index_adjacency(index, ent_map, rel_map, len(rel2id), len(ent2id), add_transpose_rel),
+                               len(ent2id))
+      os.makedirs(GRAPH_CACHE_DIR, exist_ok=True)
+      tmp = path + '.tmp%d' % os.getpid()
+      dgl.save_graphs(tmp, [graph])
+      os.replace(tmp, path)
+      print('Saved graph to', path)
+    _graphs[path] = graph
+  graph = _graphs[path]
+  if node_feature is not None:
+    graph.ndata['feat'] = torch.tensor(node_feature)
+  return graph
+
+
+def tkbc_maps(index, ent2id, rel2id):
+  # tkbc ids of the entities and relations of the TKG index, mapped once per name
+  ent_map = np.array([ent2id[e] for e in index.ent_names.tolist()], dtype=np.int64)
+  rel_map = np.array([rel2id[r] for r in index.rel_names.tolist()], dtype=np.int64)
+  return ent_map, rel_map
+
+
+def load_triplets(kg_file, ent2id, rel2id):
+  # all facts of the memory mapped TKG index as one array of tkbc ids
+  index = load_tkg_index(kg_file)
+  ent_map, rel_map = tkbc_maps(index, ent2id, rel2id)
+  return np.stack([ent_map[index.facts[:, SUB]], rel_map[index.facts[:, REL]], ent_map[index.facts[:, OBJ]]], axis=1)
+
+
+def load_times(kg_file):
+  # (start, end) years of the facts, in the order of load_triplets
+  return np.array(load_tkg_index(kg_file).facts[:, [START, END]])
+
+
+def construct_triplet_networkx(kg_file, ent2id, rel2id, node_feature, add_transpose_rel):
+  # networkx construction, slow and memory hungry, kept for debugging
+  rel_ptr, src, dst, start, end = typed_adjacency(load_triplets(kg_file, ent2id, rel2id), len(rel2id), len(ent2id),
+                                                  add_transpose_rel, load_times(kg_file))
+  adj_list = []
+  for i in range(len(rel_ptr) - 1):
+      lo, hi = rel_ptr[i], rel_ptr[i + 1]
+      adj_list.append(csc_matrix((np.ones(hi - lo, dtype=np.uint8), (src[lo:hi], dst[lo:hi])),
+                                 shape=(len(ent2id), len(ent2id))))
+  graph = multigraph_to_dgl(adj_list, node_feature)
+  # networkx orders the edges its own way, the typed adjacency is sorted by (type, src, dst)
+  u, v = graph.edges()
+  order = np.lexsort((v.numpy(), u.numpy(), graph.edata['type'].numpy()))
+  for name, years in (('start', start), ('end', end)):
+      edge_years = np.empty_like(years)
+      edge_years[order] = years
+      graph.edata[name] = torch.from_numpy(edge_years)
+  return graph
@@ -1,101 +1,60 @@
-import random
-from collections import defaultdict
+import multiprocessing
+
+import numpy as np
+
+from tkg_index import START, END, load_tkg_index, Ent2TripletView, Ents2RelTimeView, EntTime2RelEntView, Event2TimeView
 
 
 def get_ents2reltime(kg_file):
-    with open(kg_file) as f:
-        facts = f.read().strip().split('\n')
-    facts = [f.strip().split('\t') for f in facts]
-    facts_di = defaultdict(set)
-    for f in facts:
-        facts_di[(f[0], f[2])].update([(f[0], f[1], f[2], f[3], f[4])])
-    # facts_di[(f[0], f[2])].update( [(f[1], f[3], f[4])] )
-    return facts_di
+    return Ents2RelTimeView(load_tkg_index(kg_file))
 
 
 def get_ent2triplet(kg_file):
-    with open(kg_file) as f:
-        facts = f.read().strip().split('\n')
-    facts = [f.strip().split('\t') for f in facts]
-    facts_di = defaultdict(set)
-    for f in facts:
-        facts_di[(f[0])].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[(f[2])].update([(f[0], f[1], f[2], f[3], f[4])])
-    # facts_di[(f[0], f[2])].update( [(f[1], f[3], f[4])] )
-    return facts_di
+    return Ent2TripletView(load_tkg_index(kg_file))
 
 
 def get_event2time(kg_file):
-    with open(kg_file) as f:
-        facts = f.read().strip().split('\n')
-    facts = [f.strip().split('\t') for f in facts]
-    facts_di = defaultdict(set)
-    for f in facts:
-        if f[1] == 'P793' and f[2] == 'Q1190554':
-            facts_di[f[0]].update([(f[0], f[1], f[2], f[3], f[4])])
-        # facts_di[f[0]].update( [( f[1], f[3], f[4])] )
-    return facts_di
+    return Event2TimeView(load_tkg_index(kg_file))
 
 
 def get_ent_time2rel_ent(kg_file):
-    with open(kg_file) as f:
-        facts = f.read().strip().split('\n')
-    facts = [f.strip().split('\t') for f in facts]
-    facts_di = defaultdict(set)
-    for f in facts:
-        facts_di[(f[0], int(f[3]))].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[(f[0], int(f[4]))].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[(f[2], int(f[3]))].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[(f[2], int(f[4]))].update([(f[0], f[1], f[2], f[3], f[4])])
-    return facts_di
+    return EntTime2RelEntView(load_tkg_index(kg_file))
 
 
-def get_ent_time2rel_ent(kg_file):
-    with open(kg_file) as f:
-        facts = f.read().strip().split('\n')
-    facts = [f.strip().split('\t') for f in facts]
-    facts_di = defaultdict(lambda: defaultdict(set))
-    for f in facts:
-        facts_di[f[0]][int(f[3])].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[f[0]][int(f[4])].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[f[2]][int(f[3])].update([(f[0], f[1], f[2], f[3], f[4])])
-        facts_di[f[2]][int(f[4])].update([(f[0], f[1], f[2], f[3], f[4])])
-    return facts_di
-
-
-def get_kg_facts_for_datapoint(e, e2tr, e2rt, et2re, event2time, thresh, time_delta=10):
+def get_kg_facts_for_datapoint(e, index, thresh, rng, time_delta=10):
+    # fact ids of the TKG index that hold the annotated entities/timestamps of question e
     keys = e['annotation'].keys()
+    ent = lambda key: index.entity_id(e['annotation'][key])
+    none = np.zeros(0, dtype=np.int64)
 
     if ('head' in keys) and ('tail' in keys) and ('tail2' in keys):
-        head, tail, tail2 = e['annotation']['head'], e['annotation']['tail'], e['annotation']['tail2']
-        return e2rt[(head, tail)].union(e2rt[(head, tail2)].union(e2rt[(tail, tail2)]))
+        head, tail, tail2 = ent('head'), ent('tail'), ent('tail2')
+        pairs = [(h, t) for h, t in [(head, tail), (head, tail2), (tail, tail2)] if h >= 0 and t >= 0]
+        # a set union as before, so a fact of two pairs gets one corruption draw
+        return np.unique(np.concatenate([none] + [index.pair(h, t) for h, t in pairs]))
     elif ('head' in keys) and ('tail' in keys):
-        head, tail = e['annotation']['head'], e['annotation']['tail']
-        return e2rt[(head, tail)]
+        head, tail = ent('head'), ent('tail')
+        return index.pair(head, tail) if head >= 0 and tail >= 0 else none
     elif ('event_head' in keys) and ('tail' in keys):
-        #         pdb.set_trace()
-        event_occ = event2time[e['annotation']['event_head']]
+        event, tail = ent('event_head'), ent('tail')
+        event_occ = index.event(event) if event >= 0 else none
+        if tail < 0:
+            return event_occ
         if len(event_occ) > 0:
-            event = next(iter(event_occ))
-        tail_facts = [f for time, facts in et2re[e['annotation']['tail']].items() for f in facts]
-        # """
-        if len(event_occ) > 0:
-            tail_facts = [f for f in tail_facts if
-                          (int(f[3]) >= (int(event[3]) - time_delta)) and (int(f[4]) <= (int(event[4]) + time_delta))]
-        # tail_facts = [f for f in tail_facts if (int(f[0]) >= (int(event[0]) - time_delta)) and (int(f[1]) <= (int(event[1]) + time_delta))]
-        tail_facts = random.sample(tail_facts, thresh - 1) if len(tail_facts) > (thresh - 1) else tail_facts
-        # """
-        return set(list(event_occ) + tail_facts)
+            # tail facts inside the event window, from the interval index
+            event = index.facts[event_occ[0]]
+            tail_facts = index.within(tail, int(event[START]) - time_delta, int(event[END]) + time_delta)
+        else:
+            tail_facts = index.within(tail, None, None)
+        if len(tail_facts) > (thresh - 1):
+            tail_facts = rng.choice(tail_facts, thresh - 1, replace=False)
+        return np.unique(np.concatenate([event_occ, tail_facts]))
     elif 'time' in keys:
-        ent = e['annotation']['head'] if 'head' in keys else e['annotation']['tail']
-        return et2re[ent][int(e['annotation']['time'])]
+        e_id = ent('head') if 'head' in keys else ent('tail')
+        return index.at_time(e_id, int(e['annotation']['time'])) if e_id >= 0 else none
     else:
-        if ('head' in keys):
-            ent = e['annotation']['head']
-        else:
-            ent = e['annotation']['tail']
-
-        return e2tr[ent]
+        e_id = ent('head') if 'head' in keys else ent('tail')
+        return index.entity(e_id) if e_id >= 0 else none
 
 
 def append_time_to_question(question, facts):
@@ -108,48 +67,92 @@ def append_time_to_question(question, facts):
         question['template'] = question['template'] + ', {time1}, {time2}'
 
 
-def retrieve_time_for_question(d, facts, corrupt_p):
-    whether_to_corrupt = [0, 1]
-    corrupt_probs = [(1 - corrupt_p), corrupt_p]
-    facts = list(facts)
-    if len(facts) > 0:
-        d['fact'] = []
-        for f in facts:
-            # probability of corruption during QA
-            if random.choices(whether_to_corrupt, corrupt_probs, k=1)[0] == 0:
-                d['fact'].append([f[3], f[4]])
-    else:
-        d['fact'] = []
-    return
-
-
-def add_facts_to_data(data, corrupt_p, fuse, e2tr, e2rt, et2re, event2time, thresh=5):
-    for d in data:
-        facts = get_kg_facts_for_datapoint(d, e2tr, e2rt, et2re, event2time, thresh)
-        facts = sorted(facts, key=lambda x: x[3])
-
-        # remove `no_time' if corrupted
-        facts = [x for x in facts if x != 9620]
-
-        # TempoQR-att appends to the question
-        if fuse == 'att':
-            append_time_to_question(d, facts)
-        else:
-            retrieve_time_for_question(d, facts, corrupt_p)
-    return data
-
-
-def retrieve_times(kg_file, dataset_name, data, corrupt_p, fuse):
+def years_to_time_ids(years, ts2id):
+    # through a dense year -> time id table, -1 for years without a time id
+    ts_years = np.array([t[0] for t in ts2id.keys()], dtype=np.int64)
+    first = ts_years.min()
+    table = np.full(ts_years.max() - first + 1, -1, dtype=np.int64)
+    table[ts_years - first] = list(ts2id.values())
+    pos = years - first
+    if len(pos) > 0 and (pos.min() < 0 or pos.max() >= len(table) or table[pos].min() < 0):
+        raise KeyError('year without a time id in %s' % years)
+    return table[pos]
+
+
+def add_times_to_data(data, corrupt_p, fuse, index, ts2id, rng, thresh=5):
+    """
+    Hard supervision for all questions at once: the earliest start and latest end of the retrieved facts
+    that survive corruption, as time id arrays, and the mask of questions that have such a fact. The others
+    get time id 0, which is a real time id as well.
+    """
+    fact_ids = [get_kg_facts_for_datapoint(d, index, thresh, rng) for d in data]
+
+    # TempoQR-att appends to the question
+    if fuse == 'att':
+        for d, ids in zip(data, fact_ids):
+            append_time_to_question(d, sorted(index.to_tuples(ids), key=lambda x: x[3]))
+
+    counts = np.array([len(ids) for ids in fact_ids], dtype=np.int64)
+    fact_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + fact_ids)
+    question = np.repeat(np.arange(len(data)), counts)
+
+    # probability of corruption during QA, one draw for every retrieved fact
+    keep = rng.random(len(fact_ids)) >= corrupt_p
+    facts = index.facts[fact_ids[keep]]
+    start_year = np.full(len(data), np.iinfo(np.int64).max)
+    end_year = np.full(len(data), np.iinfo(np.int64).min)
+    np.minimum.at(start_year, question[keep], facts[:, START])
+    np.maximum.at(end_year, question[keep], facts[:, END])
+
+    found = start_year <= end_year
+    start_time = np.zeros(len(data), dtype=np.int64)
+    end_time = np.zeros(len(data), dtype=np.int64)
+    start_time[found] = years_to_time_ids(start_year[found], ts2id)
+    end_time[found] = years_to_time_ids(end_year[found], ts2id)
+    return start_time, end_time, found
+
+
+# questions per shard; fixed so that the per-shard seeds do not depend on the number of workers
+SHARD_SIZE = 4096
+# read by forked shard workers instead of pickling the questions to them
+_shard_state = {}
+
+
+def _times_for_shard(job):
+    start, stop, seed = job
+    state = _shard_state
+    data = state['data'][start:stop]
+    index = load_tkg_index(state['kg_file'])
+    rng = np.random.default_rng(seed)
+    start_time, end_time, found = add_times_to_data(data, state['corrupt_p'], state['fuse'], index, state['ts2id'],
+                                                    rng)
+    # questions only change (and need to be sent back) when times are appended to them
+    return start_time, end_time, found, data if state['fuse'] == 'att' else None
+
+
+def retrieve_times(kg_file, dataset_name, data, corrupt_p, fuse, ts2id, seed=None, num_workers=1):
     # kg_file could involve a corrupt TKG
     kg_file = f'data/{dataset_name}/kg/' + kg_file
-
-    # collecting possible combinations of annotated entities/timestamps
-    e2tr = get_ent2triplet(kg_file)
-    e2rt = get_ents2reltime(kg_file)
-    et2re = get_ent_time2rel_ent(kg_file)
-    event2time = get_event2time(kg_file)
-
-    # collect all the question-specific timestmaps
-    data = add_facts_to_data(data, corrupt_p, fuse, e2tr, e2rt, et2re, event2time)
-
-    return data
+    # build or open the index before forking, workers share its memory map
+    load_tkg_index(kg_file)
+
+    # collect all the question-specific timestmaps, shard by shard
+    starts = list(range(0, len(data), SHARD_SIZE))
+    seeds = np.random.SeedSequence(seed).spawn(len(starts))
+    jobs = [(start, min(start + SHARD_SIZE, len(data)), s) for start, s in zip(starts, seeds)]
+    _shard_state.update(data=data, kg_file=kg_file, corrupt_p=corrupt_p, fuse=fuse, ts2id=ts2id)
+    try:
+        if num_workers > 1 and len(jobs) > 1:
+            with multiprocessing.get_context('fork').Pool(min(num_workers, len(jobs))) as pool:
+                results = pool.map(_times_for_shard, jobs)
+        else:
+            results = [_times_for_shard(job) for job in jobs]
+    finally:
+        _shard_state.clear()
+
+    if fuse == 'att':
+        data = [d for _, _, _, shard in results for d in shard]
+    start_time = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[0] for r in results])
+    end_time = np.concatenate([np.zeros(0, dtype=np.int64)] + [r[1] for r in results])
+    found = np.concatenate([np.zeros(0, dtype=bool)] + [r[2] for r in results])
+    return data, start_time, end_time, found
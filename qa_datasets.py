@@ -4,9 +4,12 @@ import pickle
 from collections import defaultdict
 from typing import Dict, Tuple, List
 import json
+import multiprocessing
+import time
 
 import numpy as np
 import torch
+import dgl
 # from qa_models import QA_model
 import utils
 from tqdm import tqdm
@@ -24,7 +27,8 @@ from collections import defaultdict
 import random
 
 from construct_graph import construct_triplet
-from hard_supervision_functions import retrieve_times
+from subgraphs import graph_csr, hop_profile, load_khop_index
+from hard_supervision_functions import SHARD_SIZE, retrieve_times, get_ents2reltime, get_event2time, get_ent2triplet
 
 class QA_Dataset(Dataset):
     def __init__(self, 
@@ -127,7 +131,10 @@ class QA_Dataset(Dataset):
 
     def getAnswersFromScores(self, scores, largest=True, k=10):
         _, ind = torch.topk(scores, k, largest=largest)
-        predict = ind
+        return self.getAnswersFromIds(ind)
+
+    def getAnswersFromIds(self, predict):
+        # answers of entity/time ids as getAnswersFromScores returns them
         answers = []
         for a_id in predict:
             a_id = a_id.item()
@@ -383,8 +390,44 @@ class QA_Dataset_Baseline(QA_Dataset):
         return {"type2num":type2num, "total_num":len(self.data_ids_filtered)}.__str__()
 
 
+# dataset being prepared by forked shard workers, see QA_Dataset_Sub.prepare_data_sharded
+_shard_dataset = None
+
+
+def _prepare_shard(job):
+    start, stop, hard_start_time, hard_end_time, hard_found = job
+    data = _shard_dataset.addEntityAnnotation(_shard_dataset.data[start:stop])
+    return data, _shard_dataset.prepare_data2(data, hard_start_time, hard_end_time, hard_found)
+
+
+class BatchedGraph(object):
+    """
+    Question subgraphs of a batch: either dgl.batch of one subgraph per question, or with members the
+    union of them, where members[0] are question indices and members[1] their nodes in the union.
+    size and copies count nodes+edges of the graph and of the per-question subgraphs it replaces,
+    records are the per-question telemetry of --subgraph_log.
+    DataLoader(pin_memory=True) pins batch elements through their pin_memory method, which DGLGraph lacks.
+    """
+    def __init__(self, graph, members=None, copies=None, records=None):
+        self.graph = graph
+        self.members = members
+        self.records = records
+        self.size = graph.num_nodes() + graph.num_edges()
+        self.copies = self.size if copies is None else copies
+
+    def pin_memory(self):
+        self.graph.pin_memory_()
+        if self.members is not None:
+            self.members = self.members.pin_memory()
+        return self
+
+    def to(self, device, non_blocking=False):
+        members = None if self.members is None else self.members.to(device, non_blocking=non_blocking)
+        return BatchedGraph(self.graph.to(device, non_blocking=non_blocking), members, self.copies, self.records)
+
+
 class QA_Dataset_Sub(QA_Dataset):
-    def __init__(self, split, dataset_name, args,  tkbc_model, tokenization_needed=True):
+    def __init__(self, split, dataset_name, args,  tkbc_model, tokenization_needed=True, subgraph_cache=None):
         super().__init__(split, dataset_name, tokenization_needed)
         print('Preparing data for split %s' % split)
         ents = self.all_dicts['ent2id'].keys()
@@ -395,29 +438,76 @@ class QA_Dataset_Sub(QA_Dataset):
 
         # Aware module
         if args.aware_module:
-            with open('./LGQA/saved_pkl/e2rt.pkl', 'rb') as f:
-                self.e2rt = pickle.load(f)
-            with open('./LGQA/saved_pkl/event2time.pkl', 'rb') as f:
-                self.event2time = pickle.load(f)
-            with open('./LGQA/saved_pkl/e2tr.pkl', 'rb') as f:
-                self.e2tr = pickle.load(f)
+            kg_file = f'data/{dataset_name}/kg/' + args.tkg_file
+            self.e2rt = get_ents2reltime(kg_file)
+            self.event2time = get_event2time(kg_file)
+            self.e2tr = get_ent2triplet(kg_file)
             self.implicit_parsing(self.data)
 
         self.node_feature = tkbc_model.embeddings[0].weight.data.cpu()
-        self.rel_feature = tkbc_model.embeddings[1].weight.data.cpu()
         #args: given TKG, whether to corrupt hard, and how to use the reitrieved timestmaps
-        self.data = retrieve_times(args.tkg_file, args.dataset_name, self.data, args.corrupt_hard, args.fuse)
-        self.dgl_graph = construct_triplet(args.tkg_file, args.dataset_name, self.all_dicts['ent2id'], self.all_dicts['rel2id'], \
-        self.node_feature, self.rel_feature, add_transpose_rel=True)
+        self.data, hard_start_time, hard_end_time, hard_found = retrieve_times(args.tkg_file, args.dataset_name, self.data,
+                                                                  args.corrupt_hard, args.fuse, self.all_dicts['ts2id'],
+                                                                  seed=args.prep_seed, num_workers=args.prep_workers)
+        # the graph and question subgraphs only feed the subgraph module
+        self.subgraph_module = args.subgraph_module
+        self.dgl_graph = None
+        if self.subgraph_module:
+            self.dgl_graph = construct_triplet(args.tkg_file, args.dataset_name, self.all_dicts['ent2id'], self.all_dicts['rel2id'], \
+            self.node_feature, add_transpose_rel=True)
         
         
-        self.data = self.addEntityAnnotation(self.data)
         self.num_total_entities = len(self.all_dicts['ent2id'])
         self.num_total_times = len(self.all_dicts['ts2id'])
         self.padding_idx = self.num_total_entities + self.num_total_times  # padding id for embedding of ent/time
         self.answer_vec_size = self.num_total_entities + self.num_total_times
           
-        self.prepared_data = self.prepare_data2(self.data)
+        if args.prep_workers > 1:
+            self.data, self.prepared_data = self.prepare_data_sharded(hard_start_time, hard_end_time, hard_found,
+                                                                      args.prep_workers)
+        else:
+            self.data = self.addEntityAnnotation(self.data)
+            self.prepared_data = self.prepare_data2(self.data, hard_start_time, hard_end_time, hard_found)
+
+        self.khop = args.khop
+        self.khop_index = None
+        if self.subgraph_module and args.khop_index:
+            seeds = [e for ents in self.prepared_data['question_ent2id'] for e in ents]
+            self.khop_index = load_khop_index(self.dgl_graph, args.khop, seeds)
+        # fan-out capped sampling instead of full k-hop subgraphs, temporal sampling needs the question years
+        self.sampling = args.subgraph_sampling
+        self.fanout = args.fanout
+        self.node_budget = args.node_budget
+        self.sampling_seed = args.sampling_seed
+        # time-scoped extraction only follows edges overlapping the question years +- time_margin
+        self.time_scope = args.time_scope
+        self.time_margin = args.time_margin
+        self.id2year = np.zeros(len(self.all_dicts['ts2id']), dtype=np.int64)
+        for ts, i in self.all_dicts['ts2id'].items():
+            self.id2year[i] = ts[0]
+        self.union_subgraph = args.union_subgraph
+        self.subgraph_log = args.subgraph_log != ''
+        if self.subgraph_log:
+            self.id2ent = {v: k for k, v in self.all_dicts['ent2id'].items()}
+        # a SubgraphCache shared with the other splits
+        self.subgraph_cache = subgraph_cache if self.subgraph_module else None
+
+    def prepare_data_sharded(self, hard_start_time, hard_end_time, hard_found, num_workers):
+        # addEntityAnnotation + prepare_data2 over question shards in forked workers, merged back in order
+        global _shard_dataset
+        jobs = [(start, min(start + SHARD_SIZE, len(self.data)))
+                for start in range(0, len(self.data), SHARD_SIZE)]
+        jobs = [(start, stop, hard_start_time[start:stop], hard_end_time[start:stop], hard_found[start:stop])
+                for start, stop in jobs]
+        _shard_dataset = self
+        try:
+            with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                results = pool.map(_prepare_shard, jobs)
+        finally:
+            _shard_dataset = None
+        data = [d for shard, _ in results for d in shard]
+        prepared_data = {key: [x for _, prepared in results for x in prepared[key]] for key in results[0][1]}
+        return data, prepared_data
 
     def __len__(self):
         return len(self.data)
@@ -553,10 +643,12 @@ class QA_Dataset_Sub(QA_Dataset):
         #print(entity_time_final)
         return tokenized, entity_time_final, entity_mask
 
-    def prepare_data2(self, data):
+    def prepare_data2(self, data, hard_start_time, hard_end_time, hard_found):
         # we want to prepare answers lists for each question
         # then at batch prep time, we just stack these
         # and use scatter
+        # hard_start_time/hard_end_time: time ids retrieved by hard supervision, used if the question has no time,
+        # hard_found: whether anything was retrieved
         heads = []
         times = []
         start_times = []
@@ -573,7 +665,8 @@ class QA_Dataset_Sub(QA_Dataset):
         num_total_entities = len(self.all_dicts['ent2id'])
         answers_arr = []
         question_ent2id = []
-        for question in tqdm(data):
+        has_time = []
+        for i, question in enumerate(tqdm(data)):
             # randomly sample pp
             # in test there is only 1 pp, so always pp_id=0
             # TODO: this random is causing assertion bug later on
@@ -605,30 +698,14 @@ class QA_Dataset_Sub(QA_Dataset):
                 time = self.timesToIds(times_in_question)[0]  # take a time. if no time then 0
                 start_time = time
                 end_time = time
+                question_has_time = True
                 # exit(0)
             else:
                 time = 0
-                #check for retrieved timestmaps
-                if len(question['fact']) > 0:
-                    ts = []
-                    #add all timestmaps and sort
-                    for f in question['fact']:
-                        for t in range(int(f[0]), int(f[1])+1):
-                            ts.append(t)
-                    ts = sorted(ts)
-                    sorted_times = self.timesToIds(ts)
-                    
-                    try:
-                        start_time = sorted_times[0]   # for random random.choice(sorted_times)
-                    except:
-                        start_time = 0
-                    try:
-                        end_time = sorted_times[-1]
-                    except:
-                        end_time = 0
-                else:
-                    start_time = 0
-                    end_time = 0
+                # retrieved timestamps, 0 if nothing was retrieved
+                start_time = int(hard_start_time[i])
+                end_time = int(hard_end_time[i])
+                question_has_time = bool(hard_found[i])
 
                 # print('No time in qn!')
 
@@ -644,6 +721,7 @@ class QA_Dataset_Sub(QA_Dataset):
             rel = self.all_dicts['rel2id'][list(question['relations'])[0]]
             rels.append(rel)
             question_ent2id.append(entity2id)
+            has_time.append(question_has_time)
             
             tokenized, entity_time_final, entity_mask = self.get_entity_aware_tokenization(nl_question, et_text, et_ids)
             assert len(tokenized) == len(entity_time_final)
@@ -670,7 +748,57 @@ class QA_Dataset_Sub(QA_Dataset):
                 'types':types,
                 'rels':rels,
                 'answers_arr': answers_arr,
-                'question_ent2id': question_ent2id}
+                'question_ent2id': question_ent2id,
+                'has_time': has_time}
+
+    def batch_subgraphs(self, question_ent2id, windows):
+        csr = graph_csr(self.dgl_graph)
+        ids = []
+        records = [] if self.subgraph_log else None
+        for ents, window in zip(question_ent2id, windows):
+            start = time.perf_counter()
+            ids.append(self.subgraph_ids(ents, window))
+            if records is not None:
+                nodes, edges = hop_profile(csr, ents, *ids[-1])
+                records.append({'seeds': [self.id2ent[e] for e in sorted(set(ents))], 'nodes': nodes, 'edges': edges,
+                                'extract_ms': 1000. * (time.perf_counter() - start)})
+        if not self.union_subgraph:
+            return BatchedGraph(dgl.batch([csr.subgraph(nodes, eids) for nodes, eids in ids]), records=records)
+        # one graph holding every node and edge of the batch once, questions read out their own nodes
+        nodes = np.unique(np.concatenate([x[0] for x in ids]))
+        eids = np.unique(np.concatenate([x[1] for x in ids]))
+        members = torch.from_numpy(np.stack([np.repeat(np.arange(len(ids)), [len(x[0]) for x in ids]),
+                                             np.searchsorted(nodes, np.concatenate([x[0] for x in ids]))]))
+        copies = sum(len(x[0]) + len(x[1]) for x in ids)
+        return BatchedGraph(csr.subgraph(nodes, eids), members, copies, records)
+
+    def subgraph_ids(self, question_ent2id, window=None):
+        # (node ids, edge ids) of the question subgraph. window is the (start, end) year of the question,
+        # None if it has no time
+        scope = None
+        if self.time_scope and window is not None:
+            scope = (window[0] - self.time_margin, window[1] + self.time_margin)
+        if self.sampling != 'temporal':
+            window = None
+        if self.subgraph_cache is not None:
+            return self.subgraph_cache.get(question_ent2id, self.khop,
+                                           lambda ents: self._subgraph_ids(ents, window, scope),
+                                           scope=(window, scope))
+        return self._subgraph_ids(question_ent2id, window, scope)
+
+    def _subgraph_ids(self, question_ent2id, window=None, scope=None):
+        csr = graph_csr(self.dgl_graph)
+        if self.sampling is not None:
+            # seeded by the question entities, so a question gets the same sample in every epoch and worker
+            rng = np.random.default_rng([self.sampling_seed] + sorted(set(question_ent2id)))
+            nodes = csr.sample_nodes(question_ent2id, self.khop, self.fanout, self.node_budget, self.sampling,
+                                     rng, window, scope)
+            return nodes, csr.induced_edges(nodes, scope)
+        if self.khop_index is not None and scope is None:
+            return self.khop_index.subgraph_ids(question_ent2id)
+        # the k-hop index holds unscoped neighbourhoods, scoped ones are a BFS over the in-scope edges
+        nodes = csr.khop_nodes(question_ent2id, self.khop, scope)
+        return nodes, csr.induced_edges(nodes, scope)
 
     # tokenization function taken from NER code
     def tokenize(self, words):
@@ -709,7 +837,8 @@ class QA_Dataset_Sub(QA_Dataset):
         types = data['types'][index]
         rels = data['rels'][index]
         question_ent2id = data['question_ent2id'][index]
-        return question_text, tokenized_question, entity_time_ids, entity_mask, head, tail, time, start_time, end_time, tail2, types, rels, answers_single, question_ent2id
+        has_time = data['has_time'][index]
+        return question_text, tokenized_question, entity_time_ids, entity_mask, head, tail, time, start_time, end_time, tail2, types, rels, answers_single, question_ent2id, has_time
 
     def pad_for_batch(self, to_pad, padding_val, dtype=np.long):
         padded = np.ones([len(to_pad), len(max(to_pad, key=lambda x: len(x)))], dtype=dtype) * padding_val
@@ -758,8 +887,11 @@ class QA_Dataset_Sub(QA_Dataset):
         answers_single = torch.from_numpy(np.array([item[12] for item in items]))
         question_ent2id = [item[13] for item in items]
         question_ent2id_padded = torch.from_numpy(self.pad_for_batch(question_ent2id, -1, np.long))
+        # subgraphs are extracted and batched here, in the loader workers, so the model only moves them to the gpu
+        windows = [(self.id2year[item[7]], self.id2year[item[8]]) if item[14] else None for item in items]
+        batch_graph = self.batch_subgraphs(question_ent2id, windows) if self.subgraph_module else None
 
-        return input_ids, attention_mask, entity_time_ids_padded, entity_mask_padded, heads, tails, times, start_times, end_times, tails2, types,rels, answers_single, question_ent2id_padded
+        return input_ids, attention_mask, entity_time_ids_padded, entity_mask_padded, heads, tails, times, start_times, end_times, tails2, types,rels, answers_single, question_ent2id_padded, batch_graph
     
 
 
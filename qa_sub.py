@@ -1,16 +1,56 @@
 import math
+import time
 import torch
 from torch import nn
 import numpy as np
 import dgl
 from dgl.nn import WeightAndSum
-from attention_diffusion import GATNet
+from attention_diffusion import GATNet, EdgeIndex, checkpointed
 from dgl.nn.pytorch.glob import WeightAndSum
 from tcomplex import TComplEx
 from transformers import DistilBertModel
 from torch.nn import LayerNorm
 import torch.nn.functional as F
 
+# parameters of branches only built when their switch is on, see QA_Sub.load_state_dict
+OPTIONAL_BRANCHES = ('graph_node_linear1.', 'graph_node_linear2.', 'graph_rel_linear1.', 'graph_rel_linear2.',
+                     'bn2.', 'gatnet.', 'weight_and_sum.', 'linearT.', 'lin_cat.', 'entity_linear.')
+
+
+def checkpointed_encoder(encoder, src, src_key_padding_mask=None):
+    # nn.TransformerEncoder recomputing the activations of every layer in backward instead of keeping them
+    for layer in encoder.layers:
+        src = checkpointed(layer, src, None, src_key_padding_mask)
+    if encoder.norm is not None:
+        src = encoder.norm(src)
+    return src
+
+
+def streaming_topk(chunks, k, targets=None):
+    """
+    Top k of every row of a score matrix given as (offset, scores) chunks of its columns, without building it.
+    Returns the top scores, their column ids, the logsumexp of every row and, with targets, the score of the
+    target column of every row, so the cross entropy is lse - target.
+    """
+    values = ids = lse = target = None
+    for offset, scores in chunks:
+        chunk_values, chunk_ids = scores.topk(min(k, scores.shape[1]), dim=1)
+        chunk_ids = chunk_ids + offset
+        if values is not None:
+            chunk_values, top = torch.cat((values, chunk_values), dim=1).topk(
+                min(k, values.shape[1] + chunk_values.shape[1]), dim=1)
+            chunk_ids = torch.cat((ids, chunk_ids), dim=1).gather(1, top)
+        values, ids = chunk_values, chunk_ids
+        chunk_lse = torch.logsumexp(scores, dim=1)
+        lse = chunk_lse if lse is None else torch.logaddexp(lse, chunk_lse)
+        if targets is not None:
+            if target is None:
+                target = scores.new_zeros(len(scores))
+            inside = (targets >= offset) & (targets < offset + scores.shape[1])
+            target[inside] = scores[inside, targets[inside] - offset]
+    return values, ids, lse, target
+
+
 class QA_Sub(nn.Module):
     def __init__(self, tkbc_model, args):
         super().__init__()
@@ -19,6 +59,17 @@ class QA_Sub(nn.Module):
         self.supervision = args.supervision
         self.extra_entities = args.extra_entities
         self.fuse = args.fuse
+        self.subgraph_module = args.subgraph_module
+        # SubgraphTelemetry recording the GAT time of every batch, see --subgraph_log
+        self.telemetry = None
+        # node representations of the whole-graph GAT while evaluating with --whole_graph_eval, see cache_graph
+        self.whole_graph_eval = args.whole_graph_eval
+        self.graph_chunk_size = args.graph_chunk_size
+        self.node_cache = None
+        # evaluation scores entities in chunks of score_chunk_size, keeping the top answers, see forward_topk
+        self.score_chunk_size = args.score_chunk_size
+        # activation checkpointing of the GAT layers and the transformer layers while training
+        self.checkpoint_activations = args.checkpoint_activations
         
         self.tkbc_embedding_dim = tkbc_model.embeddings[0].weight.shape[1]
         self.tkbc_rel_embedding_dim = tkbc_model.embeddings[1].weight.shape[1] # 512
@@ -77,8 +128,10 @@ class QA_Sub(nn.Module):
         self.layer_norm = nn.LayerNorm(self.transformer_dim)
 
         self.linear = nn.Linear(768, self.tkbc_embedding_dim)  # to project question embedding
-        self.linearT = nn.Linear(768, self.tkbc_embedding_dim)  # to project question embedding
-        self.lin_cat = nn.Linear(3 * self.transformer_dim, self.transformer_dim)
+        if self.time_sensitivity:
+            self.linearT = nn.Linear(768, self.tkbc_embedding_dim)  # to project question embedding
+        if self.fuse == 'cat':
+            self.lin_cat = nn.Linear(3 * self.transformer_dim, self.transformer_dim)
 
         self.linear1 = nn.Linear(self.tkbc_embedding_dim, self.tkbc_embedding_dim)
         self.linear2 = nn.Linear(self.tkbc_embedding_dim, self.tkbc_embedding_dim)
@@ -87,16 +140,21 @@ class QA_Sub(nn.Module):
         self.bn1 = torch.nn.BatchNorm1d(self.tkbc_embedding_dim)
         #self.bn2 = torch.nn.BatchNorm1d(self.tkbc_embedding_dim)
 
+        #self.node_rel_rep = 128
+        self.hidden = 128
+        self.final = 128
+
+        if self.extra_entities:
+            self.entity_linear = nn.Linear(3*self.tkbc_embedding_dim+self.final, num_entities) # the first dimension whether to plus self.final
+        if not self.subgraph_module:
+            return
+
         # Graph attention network
         num_layers = 3
         k = 3
         alpha = 0.5
         num_heads = 2
 
-        #self.node_rel_rep = 128
-        self.hidden = 128
-        self.final = 128
-
         self.graph_node_linear1 = nn.Linear(self.tkbc_embedding_dim, self.hidden)
         self.graph_node_linear2 = nn.Linear(self.hidden, self.final)
 
@@ -105,13 +163,46 @@ class QA_Sub(nn.Module):
 
         #self.linear2 = nn.Linear(self.tkbc_embedding_dim + self.final, self.tkbc_embedding_dim) # whether to plus self.final
         self.bn2 = nn.BatchNorm1d(self.tkbc_embedding_dim) # some problem
-        self.entity_linear = nn.Linear(3*self.tkbc_embedding_dim+self.final, num_entities) # the first dimension whether to plus self.final
 
-        self.gatnet = GATNet(self.hidden, self.hidden, self.hidden, self.final, num_layers, k, alpha, num_heads, merge='mean')
+        self.gatnet = GATNet(self.hidden, self.hidden, self.hidden, self.final, num_layers, k, alpha, num_heads, merge='mean',
+                             attention_once=args.attention_once, backend=args.gat_backend,
+                             checkpoint=args.checkpoint_activations)
         self.weight_and_sum = WeightAndSum(self.final)
 
         return
 
+    def load_state_dict(self, state_dict, strict=True):
+        # checkpoints may hold branches this configuration did not build, or lack ones it did
+        own = super().state_dict()
+        built = tuple(p for p in OPTIONAL_BRANCHES if any(k.startswith(p) for k in own))
+        state_dict = {k: v for k, v in state_dict.items() if not k.startswith(OPTIONAL_BRANCHES) or k.startswith(built)}
+        absent = tuple(p for p in built if not any(k.startswith(p) for k in state_dict))
+        missing = [k for k in own if k.startswith(absent)]
+        if missing:
+            print('Checkpoint lacks %d parameters of optional branches, keeping their initialization' % len(missing))
+            state_dict.update((k, own[k]) for k in missing)
+        return super().load_state_dict(state_dict, strict)
+
+    def cache_graph(self, graph):
+        # the GAT over the whole graph once, in node chunks, instead of over every question subgraph. Question
+        # readouts gather their nodes from node_cache until it is reset
+        with torch.no_grad():
+            h = self.graph_node_linear1(self.dropout(graph.ndata['feat'].cuda()))
+            h = self.graph_node_linear2(self.dropout(F.relu(h)))
+            rel = self.graph_rel_linear1(self.dropout(self.tkbc_model.embeddings[1].weight.detach()))
+            rel = self.graph_rel_linear2(self.dropout(F.relu(rel)))
+            src, dst = graph.edges()
+            edges = EdgeIndex(src, dst, graph.num_nodes(), {'rel': graph.edata['type']}).to('cuda')
+            self.node_cache = self.gatnet.forward_chunked(edges, h, rel, self.graph_chunk_size)
+
+    def readout(self, subgraphs, h, num_questions):
+        # WeightAndSum per question. Over a union graph a question sums the weighted nodes it contains
+        if subgraphs.members is None:
+            return self.weight_and_sum(subgraphs.graph, h)
+        weighted = self.weight_and_sum.atom_weighting(h) * h
+        out = h.new_zeros(num_questions, h.shape[1])
+        return out.index_add_(0, subgraphs.members[0], weighted[subgraphs.members[1]])
+
     def invert_binary_tensor(self, tensor):
         ones_tensor = torch.ones(tensor.shape, dtype=torch.float32).cuda()
         inverted = ones_tensor - tensor
@@ -137,7 +228,8 @@ class QA_Sub(nn.Module):
                  lhs[0] * rel[0] * rhs[1] - lhs[1] * rel[1] * rhs[1]) @ time[1].t()
         )
 
-    def score_entity(self, head_embedding, tail_embedding, relation_embedding, time_embedding):
+    def score_entity(self, head_embedding, tail_embedding, relation_embedding, time_embedding, entities=None):
+        # scores of all entities, or of the entities slice only
 
         lhs = head_embedding[:, :self.tkbc_model.rank], head_embedding[:, self.tkbc_model.rank:]
         rel = relation_embedding
@@ -147,6 +239,8 @@ class QA_Sub(nn.Module):
         time = time[:, :self.tkbc_model.rank], time[:, self.tkbc_model.rank:]
 
         right = self.tkbc_model.embeddings[0].weight
+        if entities is not None:
+            right = right[entities]
         # right = self.entity_time_embedding.weight
         right = right[:, :self.tkbc_model.rank], right[:, self.tkbc_model.rank:]
 
@@ -158,47 +252,45 @@ class QA_Sub(nn.Module):
                 (lhs[1] * full_rel[0] + lhs[0] * full_rel[1]) @ right[1].t()
         )
 
-    def forward(self, a, dgl_graph):
+    def encode_subgraphs(self, subgraphs, num_questions):
+        # GAT over the question subgraphs, extracted and batched by the dataset's collate function
+        if self.telemetry is not None:
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+        subgraphs = subgraphs.to('cuda', non_blocking=True)
+        batch_graph = subgraphs.graph
+        if self.node_cache is not None:
+            h1 = self.node_cache[batch_graph.ndata[dgl.NID]]
+        else:
+            batch_f = self.dropout(batch_graph.ndata['feat'])
+            batch_f = F.relu(self.graph_node_linear1(batch_f))
+            batch_f = self.graph_node_linear2(self.dropout(batch_f))
+
+            # edges only store their relation id: project the distinct relations of the batch once, the GAT
+            # gathers their attention terms by edata['rel']
+            rel_types, edge_rel = torch.unique(batch_graph.edata['type'], return_inverse=True)
+            batch_r = self.dropout(self.tkbc_model.embeddings[1].weight.detach()[rel_types])
+            batch_r = F.relu(self.graph_rel_linear1(batch_r))
+            batch_r = self.graph_rel_linear2(self.dropout(batch_r))
+            batch_graph.edata['rel'] = edge_rel
+
+            h1 = self.gatnet(batch_graph, batch_f, batch_r)
+        h1 = self.readout(subgraphs, h1, num_questions)
+        if self.telemetry is not None:
+            torch.cuda.synchronize()
+            self.telemetry.add_batch(subgraphs.records, time.perf_counter() - start)
+        return h1
+
+    def encode_question(self, a):
         # Tokenized questions, where entities are masked from the sentence to have TKG embeddings
         question_tokenized = a[0].cuda()  # torch.Size([1, 10])
         question_attention_mask = a[1].cuda()
         entities_times_padded = a[2].cuda()
         entity_mask_padded = a[3].cuda()
 
-        # Annotated entities/timestamps
-        heads = a[4].cuda()
-        tails = a[5].cuda()
-        times = a[6].cuda()
-
         t1 = a[7].cuda()
         t2 = a[8].cuda()
 
-        # One extra entity for new before & after question type
-        tails2 = a[9].cuda()
-        
-        #Select subgraph via the question entity
-        question_ent2id_padded = a[13]
-        question_ent2id_padded_unzip = [list(filter(lambda x: x>=0, each)) for each in question_ent2id_padded]
-        graph_list = list(map(lambda x: dgl.khop_out_subgraph(dgl_graph, x, self.khop)[0], question_ent2id_padded_unzip))
-        select_entity = [graph.ndata[dgl.NID] for graph in graph_list]
-        batch_graph = dgl.batch(graph_list).to('cuda') #you wen ti
-        batch_f = self.dropout(batch_graph.ndata['feat'])
-        batch_f = F.relu(self.graph_node_linear1(batch_f))
-        batch_f = self.graph_node_linear2(self.dropout(batch_f))
-
-        batch_e = self.dropout(batch_graph.edata['emb'])
-        batch_e = F.relu(self.graph_rel_linear1(batch_e))
-        batch_graph.edata['emb'] = self.graph_rel_linear2(self.dropout(batch_e))
-
-        h1 = self.gatnet(batch_graph, batch_f)
-        h1 = self.weight_and_sum(batch_graph, h1)
-        
-        # TKG embeddings
-        head_embedding = self.entity_time_embedding(heads)
-        tail_embedding = self.entity_time_embedding(tails)
-        tail_embedding2 = self.entity_time_embedding(tails2)
-        time_embedding = self.entity_time_embedding(times)
-
         # Hard Supervision
         t1_emb = self.tkbc_model.embeddings[2](t1)
         t2_emb = self.tkbc_model.embeddings[2](t2)
@@ -248,24 +340,75 @@ class QA_Sub(nn.Module):
 
         mask2 = ~(question_attention_mask.bool()).cuda()
 
-        output = self.transformer_encoder(combined_embed, src_key_padding_mask=mask2)  # torch.Size([10, 1, 512])
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            output = checkpointed_encoder(self.transformer_encoder, combined_embed, mask2)
+        else:
+            output = self.transformer_encoder(combined_embed, src_key_padding_mask=mask2)  # torch.Size([10, 1, 512])
 
         # Answer Predictions
         relation_embedding = output[0]  # self.linear(output[0]) #cls token embedding # torch.Size([1, 512])
         relation_embedding1 = self.dropout(self.bn1(self.linear1(relation_embedding)))
         relation_embedding2 = self.dropout(self.bn1(self.linear2(relation_embedding)))
         #relation_embedding2 = self.dropout(self.bn2(self.linear2(torch.cat([relation_embedding, h1], dim=-1))))#self.dropout(self.bn1(self.linear2(relation_embedding)))
+        return relation_embedding1, relation_embedding2
+
+    def score(self, a, relation_embedding1, relation_embedding2):
+        # Annotated entities/timestamps
+        heads = a[4].cuda()
+        tails = a[5].cuda()
+        times = a[6].cuda()
+        head_embedding = self.entity_time_embedding(heads)
+        tail_embedding = self.entity_time_embedding(tails)
+        time_embedding = self.entity_time_embedding(times)
 
+        scores_time = self.score_times(head_embedding, tail_embedding, relation_embedding1)
+        scores_entity = self.score_entities(head_embedding, tail_embedding, relation_embedding2, time_embedding)
+        scores = torch.cat((scores_entity, scores_time), dim=1)
+        return scores
+
+    def score_times(self, head_embedding, tail_embedding, relation_embedding1):
         # Time sensitivity layer
         if self.time_sensitivity:
             scores_time1 = self.score_time(head_embedding, tail_embedding, relation_embedding1)
             scores_time2 = torch.matmul(relation_embedding1, self.entity_time_embedding.weight.data[self.num_entities:-1, :].T) # cuz padding idx
-            scores_time = torch.maximum(scores_time1, scores_time2)
-        else:
-            scores_time = self.score_time(head_embedding, tail_embedding, relation_embedding1)
+            return torch.maximum(scores_time1, scores_time2)
+        return self.score_time(head_embedding, tail_embedding, relation_embedding1)
+
+    def score_entities(self, head_embedding, tail_embedding, relation_embedding2, time_embedding, entities=None):
+        # the better of head->tail and tail->head
+        scores_entity1 = self.score_entity(head_embedding, tail_embedding, relation_embedding2, time_embedding, entities)
+        scores_entity2 = self.score_entity(tail_embedding, head_embedding, relation_embedding2, time_embedding, entities)
+        return torch.maximum(scores_entity1, scores_entity2)
+
+    def score_topk(self, a, relation_embedding1, relation_embedding2, k, answers=None):
+        # the columns of score() streamed through streaming_topk, score_chunk_size entities at a time and
+        # the times at once, so no (B, num_entities) matrix is built
+        heads = a[4].cuda()
+        tails = a[5].cuda()
+        times = a[6].cuda()
+        head_embedding = self.entity_time_embedding(heads)
+        tail_embedding = self.entity_time_embedding(tails)
+        time_embedding = self.entity_time_embedding(times)
 
-        scores_entity1 = self.score_entity(head_embedding, tail_embedding, relation_embedding2, time_embedding)
-        scores_entity2 = self.score_entity(tail_embedding, head_embedding, relation_embedding2, time_embedding)
-        scores_entity = torch.maximum(scores_entity1, scores_entity2)
-        scores = torch.cat((scores_entity, scores_time), dim=1)
-        return scores
+        def chunks():
+            for start in range(0, self.num_entities, self.score_chunk_size):
+                entities = slice(start, min(start + self.score_chunk_size, self.num_entities))
+                yield start, self.score_entities(head_embedding, tail_embedding, relation_embedding2, time_embedding,
+                                                 entities)
+            yield self.num_entities, self.score_times(head_embedding, tail_embedding, relation_embedding1)
+        return streaming_topk(chunks(), k, answers)
+
+    def forward(self, a):
+        if self.subgraph_module:
+            # not part of the scores yet
+            h1 = self.encode_subgraphs(a[14], len(a[0]))
+        relation_embedding1, relation_embedding2 = self.encode_question(a)
+        return self.score(a, relation_embedding1, relation_embedding2)
+
+    def forward_topk(self, a, k):
+        # ids and scores of the k best answers and the loss of a batch, from score_topk
+        if self.subgraph_module:
+            h1 = self.encode_subgraphs(a[14], len(a[0]))
+        relation_embedding1, relation_embedding2 = self.encode_question(a)
+        values, ids, lse, target = self.score_topk(a, relation_embedding1, relation_embedding2, k, a[12].cuda())
+        return values, ids, (lse - target).mean()
@@ -0,0 +1,82 @@
+"""
+Summary of a --subgraph_log file: size and time histograms, mean subgraph size per hop and the entities
+whose questions cost the most, e.g.
+    python subgraph_report.py results/wikidata_big/subgraphs.jsonl --top 20 --tag train
+"""
+import argparse
+import json
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from subgraphs import SubgraphTelemetry
+
+
+def read_log(path, tag=None):
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if tag is None or record['tag'].startswith(tag):
+                yield record
+
+
+def print_histogram(name, histogram):
+    total = sum(histogram.values())
+    print('%s (%d)' % (name, total))
+    for bucket, count in sorted(histogram.items()):
+        print('  >= %-8g %8d  %s' % (bucket, count, '#' * int(round(40. * count / max(1, total)))))
+
+
+def report(path, top, tag=None):
+    histograms = {name: Counter() for name in SubgraphTelemetry.HISTOGRAMS}
+    hop_nodes, hop_edges = [], []
+    # entity -> [questions, nodes+edges, max nodes+edges, extraction ms]
+    entities = defaultdict(lambda: [0, 0, 0, 0.])
+    batches, gat_ms = 0, 0.
+    for record in read_log(path, tag):
+        if record['type'] == 'summary':
+            for name, histogram in record['histograms'].items():
+                histograms[name].update({float(b): c for b, c in histogram.items()})
+            continue
+        batches += 1
+        gat_ms += record['gat_ms']
+        for q in record['questions']:
+            hop_nodes.append(q['nodes'])
+            hop_edges.append(q['edges'])
+            cost = sum(q['nodes']) + sum(q['edges'])
+            for e in q['seeds']:
+                stats = entities[e]
+                stats[0] += 1
+                stats[1] += cost
+                stats[2] = max(stats[2], cost)
+                stats[3] += q['extract_ms']
+    if batches == 0:
+        print('No batches in', path)
+        return
+
+    print('%d batches, %d questions, %.1f ms GAT per batch' % (batches, len(hop_nodes), gat_ms / batches))
+    for name in SubgraphTelemetry.HISTOGRAMS:
+        print_histogram(name, histograms[name])
+
+    hops = max(len(x) for x in hop_nodes)
+    nodes = np.array([x + [0] * (hops - len(x)) for x in hop_nodes], dtype=np.float64)
+    edges = np.array([x + [0] * (hops - len(x)) for x in hop_edges], dtype=np.float64)
+    print('hop  mean nodes  max nodes  mean edges  max edges')
+    for h in range(hops):
+        print('%3d  %10.1f  %9d  %10.1f  %9d' % (h, nodes[:, h].mean(), nodes[:, h].max(),
+                                                edges[:, h].mean(), edges[:, h].max()))
+
+    print('Top %d entities by total nodes+edges of their questions' % top)
+    print('%-12s %9s %12s %10s %10s' % ('entity', 'questions', 'nodes+edges', 'max', 'extract_ms'))
+    for e, (count, cost, largest, ms) in sorted(entities.items(), key=lambda x: -x[1][1])[:top]:
+        print('%-12s %9d %12d %10d %10.1f' % (e, count, cost, largest, ms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Subgraph telemetry report")
+    parser.add_argument('log')
+    parser.add_argument('--top', default=20, type=int)
+    parser.add_argument('--tag', default=None, type=str,
+                        help="only records whose tag starts with this, e.g. train or valid")
+    args = parser.parse_args()
+    report(args.log, args.top, args.tag)
@@ -0,0 +1,436 @@
+import os
+import json
+import math
+import time
+import shutil
+import hashlib
+import multiprocessing
+from collections import Counter
+
+import numpy as np
+import torch
+import dgl
+
+KHOP_CACHE_DIR = 'saved_pkl/khop_cache'
+SAMPLING_POLICIES = ('uniform', 'relation', 'temporal')
+
+
+def gather_csr(indptr, values, rows):
+    # values[indptr[r]:indptr[r + 1]] for every r in rows, concatenated without a python loop
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    ends = np.cumsum(counts)
+    return values[np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)]
+
+
+def graph_hash(graph):
+    src, dst = graph.edges()
+    h = hashlib.sha1(str(graph.num_nodes()).encode())
+    h.update(src.numpy().tobytes())
+    h.update(dst.numpy().tobytes())
+    return h.hexdigest()
+
+
+class GraphCSR(object):
+    # numpy out-edge CSR of a DGL graph, the base of all subgraph extraction here
+    def __init__(self, graph):
+        self.graph = graph
+        self.num_nodes = graph.num_nodes()
+        src, dst = graph.edges()
+        self.src, self.dst = src.numpy(), dst.numpy()
+        self.out_eid = np.argsort(self.src, kind='stable')
+        self.out_ptr = np.zeros(self.num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.src, minlength=self.num_nodes), out=self.out_ptr[1:])
+        self._mask = np.zeros(self.num_nodes, dtype=bool)
+        self.type = graph.edata['type'].numpy() if 'type' in graph.edata else None
+        self.start = graph.edata['start'].numpy() if 'start' in graph.edata else None
+        self.end = graph.edata['end'].numpy() if 'end' in graph.edata else None
+
+    def in_scope(self, eids, scope):
+        # the edges whose facts overlap the years scope=(start, end), all of them for scope None
+        if scope is None:
+            return eids
+        return eids[(self.start[eids] <= scope[1]) & (self.end[eids] >= scope[0])]
+
+    def khop_nodes(self, seeds, k, scope=None):
+        # sorted nodes reachable from seeds in at most k out-hops, as dgl.khop_out_subgraph collects them,
+        # only following edges in scope
+        mask = self._mask
+        frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+        reached = [frontier]
+        mask[frontier] = True
+        for _ in range(k):
+            nbrs = self.dst[self.in_scope(gather_csr(self.out_ptr, self.out_eid, frontier), scope)]
+            frontier = np.unique(nbrs[~mask[nbrs]])
+            if len(frontier) == 0:
+                break
+            mask[frontier] = True
+            reached.append(frontier)
+        nodes = np.sort(np.concatenate(reached))
+        mask[nodes] = False
+        return nodes
+
+    def _edge_priority(self, eids, owner, policy, rng, window):
+        # lower is better; the random part breaks ties and is below 1 so it never outranks the policy
+        noise = rng.random(len(eids))
+        if policy == 'uniform' or (policy == 'temporal' and window is None):
+            return noise
+        if policy == 'relation':
+            # the i-th edge of every relation of a node ranks before the (i+1)-th edge of any relation
+            rel = self.type[eids]
+            order = np.lexsort((noise, rel, owner))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = (owner[order][1:] != owner[order][:-1]) | (rel[order][1:] != rel[order][:-1])
+            starts = np.flatnonzero(first)
+            rank = np.empty(len(order))
+            rank[order] = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+            return rank + noise
+        if policy == 'temporal':
+            # years between the edge's facts and the question window, 0 if they overlap
+            gap = np.maximum(np.maximum(self.start[eids] - window[1], window[0] - self.end[eids]), 0)
+            return gap + noise
+        raise ValueError('unknown sampling policy %s' % policy)
+
+    def sample_nodes(self, seeds, k, fanout, budget, policy, rng, window=None, scope=None):
+        """
+        Nodes reached from seeds in at most k out-hops, following at most fanout out-edges of every node
+        per hop and stopping at budget nodes. policy orders the out-edges of a node: 'uniform' at random,
+        'relation' round robin over its relation types, 'temporal' by the years between the edge and
+        window=(start year, end year) of the question, uniform when the question has no window.
+        Only edges in scope are followed.
+        """
+        mask = self._mask
+        frontier = np.unique(np.asarray(seeds, dtype=np.int64))
+        reached = [frontier]
+        mask[frontier] = True
+        total = len(frontier)
+        for _ in range(k):
+            if total >= budget or len(frontier) == 0:
+                break
+            counts = self.out_ptr[frontier + 1] - self.out_ptr[frontier]
+            eids = gather_csr(self.out_ptr, self.out_eid, frontier)
+            owner = np.repeat(np.arange(len(frontier)), counts)
+            if scope is not None:
+                keep = (self.start[eids] <= scope[1]) & (self.end[eids] >= scope[0])
+                eids, owner = eids[keep], owner[keep]
+                counts = np.bincount(owner, minlength=len(frontier))
+            priority = self._edge_priority(eids, owner, policy, rng, window)
+            order = np.lexsort((priority, owner))
+            rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+            picked = order[rank < fanout]
+            # best edges of the whole frontier first, so the budget cuts the worst ones
+            picked = picked[np.argsort(priority[picked], kind='stable')]
+            nbrs = self.dst[eids[picked]]
+            nbrs = nbrs[~mask[nbrs]]
+            _, first = np.unique(nbrs, return_index=True)
+            frontier = nbrs[np.sort(first)][:budget - total]
+            mask[frontier] = True
+            reached.append(frontier)
+            total += len(frontier)
+            frontier = np.sort(frontier)
+        nodes = np.sort(np.concatenate(reached))
+        mask[nodes] = False
+        return nodes
+
+    def induced_edges(self, nodes, scope=None):
+        # ids of all edges in scope between the given sorted nodes, grouped by source like dgl.node_subgraph
+        mask = self._mask
+        mask[nodes] = True
+        eids = self.in_scope(gather_csr(self.out_ptr, self.out_eid, nodes), scope)
+        eids = eids[mask[self.dst[eids]]]
+        mask[nodes] = False
+        return eids
+
+    def subgraph(self, nodes, eids):
+        # like dgl.node_subgraph/edge_subgraph, from sorted node ids and the edge ids among them
+        nodes_t, eids_t = torch.from_numpy(nodes), torch.from_numpy(eids)
+        sub_g = dgl.graph((torch.from_numpy(np.searchsorted(nodes, self.src[eids])),
+                           torch.from_numpy(np.searchsorted(nodes, self.dst[eids]))), num_nodes=len(nodes))
+        for key, value in self.graph.ndata.items():
+            sub_g.ndata[key] = value[nodes_t]
+        for key, value in self.graph.edata.items():
+            sub_g.edata[key] = value[eids_t]
+        sub_g.ndata[dgl.NID] = nodes_t
+        sub_g.edata[dgl.EID] = eids_t
+        return sub_g
+
+
+_csrs = {}
+
+
+def graph_csr(graph):
+    # one GraphCSR per graph, shared by the k-hop index and sampling
+    if id(graph) not in _csrs:
+        _csrs[id(graph)] = (graph, GraphCSR(graph))
+    return _csrs[id(graph)][1]
+
+
+def _raw_to_npy(raw_path, npy_path, length, rows):
+    # the int64s of the headerless raw_path as the .npy file npy_path, copied rows at a time
+    out = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.int64, shape=(length,))
+    if length:
+        raw = np.memmap(raw_path, dtype=np.int64, mode='r', shape=(length,))
+        for lo in range(0, length, rows):
+            out[lo:lo + rows] = raw[lo:lo + rows]
+        del raw
+    out.flush()
+
+
+class KHopIndex(object):
+    """
+    Precomputed k-hop out-neighbourhoods of seed entities as CSR arrays: the sorted node set of
+    seeds[i] is nodes[node_ptr[i]:node_ptr[i + 1]] and its induced edge ids edges[edge_ptr[i]:edge_ptr[i + 1]].
+    Subgraphs of several seeds are the union of their node sets plus the edges induced by it,
+    both gathers instead of a BFS. Seeds outside the index fall back to a BFS.
+    """
+
+    def __init__(self, graph, k, arrays):
+        self.csr = graph if isinstance(graph, GraphCSR) else GraphCSR(graph)
+        self.k = k
+        self.arrays = arrays
+        for name, value in arrays.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def build(cls, graph, k, seeds, path, rows=1 << 22):
+        # writes the index to the directory path seed by seed, so only one neighbourhood and rows ids at a
+        # time are held in memory, and returns it memory mapped
+        csr = graph if isinstance(graph, GraphCSR) else GraphCSR(graph)
+        seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+        ptrs = {name: np.zeros(len(seeds) + 1, dtype=np.int64) for name in ('node', 'edge')}
+        tmp = path + '.tmp%d' % os.getpid()
+        os.makedirs(tmp)
+        try:
+            with open(os.path.join(tmp, 'nodes.raw'), 'wb') as nodes_file, \
+                    open(os.path.join(tmp, 'edges.raw'), 'wb') as edges_file:
+                for i, seed in enumerate(seeds):
+                    nodes = csr.khop_nodes([seed], k)
+                    for name, f, ids in (('node', nodes_file, nodes), ('edge', edges_file, csr.induced_edges(nodes))):
+                        f.write(ids.astype(np.int64).tobytes())
+                        ptrs[name][i + 1] = ptrs[name][i] + len(ids)
+            np.save(os.path.join(tmp, 'seeds.npy'), seeds)
+            for name, ptr in ptrs.items():
+                np.save(os.path.join(tmp, name + '_ptr.npy'), ptr)
+                raw = os.path.join(tmp, name + 's.raw')
+                _raw_to_npy(raw, os.path.join(tmp, name + 's.npy'), int(ptr[-1]), rows)
+                os.remove(raw)
+            os.rename(tmp, path)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return cls.load(csr, k, path)
+
+    @classmethod
+    def load(cls, graph, k, path):
+        arrays = {}
+        for f in sorted(os.listdir(path)):
+            arrays[f[:-len('.npy')]] = np.load(os.path.join(path, f), mmap_mode='r')
+        return cls(graph, k, arrays)
+
+    def subgraph_ids(self, seeds):
+        seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+        pos = np.searchsorted(self.seeds, seeds)
+        pos[pos == len(self.seeds)] = 0
+        if len(seeds) == 0 or not np.array_equal(self.seeds[pos], seeds):
+            nodes = self.csr.khop_nodes(seeds, self.k)
+            return nodes, self.csr.induced_edges(nodes)
+        if len(pos) == 1:
+            i = pos[0]
+            return (np.array(self.nodes[self.node_ptr[i]:self.node_ptr[i + 1]]),
+                    np.array(self.edges[self.edge_ptr[i]:self.edge_ptr[i + 1]]))
+        nodes = np.unique(gather_csr(self.node_ptr, self.nodes, pos))
+        return nodes, self.csr.induced_edges(nodes)
+
+    def subgraph(self, seeds):
+        # same subgraph as dgl.khop_out_subgraph(graph, seeds, k)[0]
+        return self.csr.subgraph(*self.subgraph_ids(seeds))
+
+
+_indexes = {}
+
+
+def load_khop_index(graph, k, seeds, cache_dir=KHOP_CACHE_DIR):
+    # built once for the graph, k and seed set, then memory mapped from cache_dir
+    seeds = np.unique(np.asarray(seeds, dtype=np.int64))
+    h = hashlib.sha1(('%s %d\n' % (graph_hash(graph), k)).encode())
+    h.update(seeds.tobytes())
+    path = os.path.join(cache_dir, 'khop%d-%s' % (k, h.hexdigest()[:16]))
+    if path not in _indexes:
+        if not os.path.isdir(path):
+            print('Building %d-hop index for %d entities' % (k, len(seeds)))
+            os.makedirs(cache_dir, exist_ok=True)
+            _indexes[path] = KHopIndex.build(graph_csr(graph), k, seeds, path)
+        else:
+            print('Loading %d-hop index from' % k, path)
+            _indexes[path] = KHopIndex.load(graph_csr(graph), k, path)
+    return _indexes[path]
+
+
+def _plain(x):
+    # scope as python ints, so keys built from numpy and python integers agree
+    if isinstance(x, (tuple, list)):
+        return tuple(_plain(v) for v in x)
+    return None if x is None else int(x)
+
+
+class SubgraphCache(object):
+    """
+    Cache of question subgraphs, as (node ids, edge ids), keyed by (sorted question entities, khop, scope) and
+    shared by every dataset given it and by all their DataLoader workers, which fork after it is created. The
+    ids live in a ring of budget int64s in shared memory, so a subgraph extracted for training is reused by
+    evaluation and the other way round. Writes overwrite the oldest entries; an entry hit in the older half of
+    the ring is copied to its head, so entries in use outlive unused ones as in an LRU cache. Entries are found
+    by the 16 byte digest of their key in a table of WAYS slots per bucket. Hit/miss counters add up over all
+    splits and workers.
+    """
+    WAYS = 4
+
+    def __init__(self, budget):
+        self.budget = budget
+        self._ring = np.frombuffer(multiprocessing.RawArray('q', budget), dtype=np.int64)
+        # key digest (2), ring position, node count, edge count of every slot, position -1 when empty
+        num_buckets = max(budget // 128, 1)
+        self._slots = np.frombuffer(multiprocessing.RawArray('q', num_buckets * self.WAYS * 5),
+                                    dtype=np.int64).reshape(num_buckets, self.WAYS, 5)
+        self._slots[:, :, 2] = -1
+        # ring head, counting up without wrapping, hits and misses; its lock guards the ring and slots too
+        self._counts = multiprocessing.Array('q', 3)
+
+    @property
+    def hits(self):
+        return self._counts[1]
+
+    @property
+    def misses(self):
+        return self._counts[2]
+
+    def get(self, ents, khop, extract, scope=None):
+        # scope holds whatever else the extraction depends on, like a sampling time window, as nested tuples of
+        # integers or None
+        key = (tuple(sorted(set(int(e) for e in ents))), khop, _plain(scope))
+        digest = np.frombuffer(hashlib.blake2b(repr(key).encode(), digest_size=16).digest(), dtype=np.int64)
+        bucket = self._slots[digest[0] % len(self._slots)]
+        with self._counts.get_lock():
+            ids = self._find(bucket, digest)
+            self._counts[1 if ids is not None else 2] += 1
+        if ids is not None:
+            return ids
+        ids = extract(ents)
+        if len(ids[0]) + len(ids[1]) <= self.budget:
+            with self._counts.get_lock():
+                self._put(bucket, digest, ids)
+        return ids
+
+    def _live(self, bucket):
+        # slots whose entry has not been overwritten yet
+        return (bucket[:, 2] >= 0) & (self._counts[0] - bucket[:, 2] <= self.budget)
+
+    def _find(self, bucket, digest):
+        for i in np.flatnonzero(self._live(bucket) & (bucket[:, 0] == digest[0]) & (bucket[:, 1] == digest[1])):
+            pos, num_nodes, num_edges = (int(x) for x in bucket[i, 2:])
+            start = pos % self.budget
+            ids = (self._ring[start:start + num_nodes].copy(),
+                   self._ring[start + num_nodes:start + num_nodes + num_edges].copy())
+            if self._counts[0] - pos > self.budget // 2:
+                bucket[i, 2] = self._write(ids)
+            return ids
+        return None
+
+    def _put(self, bucket, digest, ids):
+        # into the slot of the same key, if another worker extracted it meanwhile, else an empty or
+        # overwritten slot, else the one of the oldest entry
+        same = np.flatnonzero((bucket[:, 0] == digest[0]) & (bucket[:, 1] == digest[1]))
+        if len(same):
+            i = same[0]
+        else:
+            i = np.argmin(np.where(self._live(bucket), bucket[:, 2], -1))
+        bucket[i] = (digest[0], digest[1], self._write(ids), len(ids[0]), len(ids[1]))
+
+    def _write(self, ids):
+        # ids at the ring head, returns their position. Entries do not wrap around the end of the ring
+        cost = len(ids[0]) + len(ids[1])
+        head = self._counts[0]
+        if head % self.budget + cost > self.budget:
+            head += self.budget - head % self.budget
+        start = head % self.budget
+        self._ring[start:start + len(ids[0])] = ids[0]
+        self._ring[start + len(ids[0]):start + cost] = ids[1]
+        self._counts[0] = head + cost
+        return head
+
+    def stats(self):
+        hits, misses = self.hits, self.misses
+        return 'subgraph cache: %d hits, %d misses (%.1f%% hit rate)' % (
+            hits, misses, 100. * hits / max(1, hits + misses))
+
+
+def hop_profile(csr, seeds, nodes, eids):
+    # nodes of a subgraph by hop distance from the seeds, and edges by the hop of their source
+    src = np.searchsorted(nodes, csr.src[eids])
+    dst = np.searchsorted(nodes, csr.dst[eids])
+    hop = np.full(len(nodes), -1)
+    hop[np.searchsorted(nodes, np.unique(np.asarray(seeds, dtype=np.int64)))] = 0
+    h = 0
+    while True:
+        reached = dst[hop[src] == h]
+        reached = np.unique(reached[hop[reached] < 0])
+        if len(reached) == 0:
+            break
+        h += 1
+        hop[reached] = h
+    edge_hop = hop[src]
+    return (np.bincount(hop[hop >= 0], minlength=h + 1).tolist(),
+            np.bincount(edge_hop[edge_hop >= 0], minlength=h + 1).tolist())
+
+
+def log2_bucket(x):
+    # lower bound of the power of two bucket holding x
+    return 0 if x <= 0 else 2. ** math.floor(math.log2(x))
+
+
+class SubgraphTelemetry(object):
+    """
+    Subgraph sizes and costs appended to a JSONL log: a 'batch' record per batch with the seeds, nodes and
+    edges per hop and extraction time of every question plus the GAT time, and every `every` batches a
+    'summary' record with log2 histograms of the batches since the previous summary. Records carry tag,
+    which the caller sets to tell splits and epochs apart.
+    """
+    HISTOGRAMS = ('nodes', 'edges', 'extract_ms', 'gat_ms')
+
+    def __init__(self, path, every=100):
+        self.path = path
+        self.every = every
+        self.tag = ''
+        self.batches = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._reset()
+
+    def _reset(self):
+        self.pending = 0
+        self.histograms = {name: Counter() for name in self.HISTOGRAMS}
+
+    def _write(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def add_batch(self, records, gat_seconds):
+        self.batches += 1
+        self.pending += 1
+        gat_ms = 1000. * gat_seconds
+        for r in records:
+            self.histograms['nodes'][log2_bucket(sum(r['nodes']))] += 1
+            self.histograms['edges'][log2_bucket(sum(r['edges']))] += 1
+            self.histograms['extract_ms'][log2_bucket(r['extract_ms'])] += 1
+        self.histograms['gat_ms'][log2_bucket(gat_ms)] += 1
+        self._write({'type': 'batch', 'tag': self.tag, 'batch': self.batches, 'time': time.time(), 'gat_ms': gat_ms,
+                     'questions': records})
+        if self.batches % self.every == 0:
+            self.flush()
+
+    def flush(self):
+        if self.pending == 0:
+            return
+        self._write({'type': 'summary', 'tag': self.tag, 'batch': self.batches, 'time': time.time(), 'batches': self.pending,
+                     'histograms': {name: {'%g' % b: c for b, c in sorted(h.items())}
+                                    for name, h in self.histograms.items()}})
+        self._reset()
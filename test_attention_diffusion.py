@@ -0,0 +1,46 @@
+import dgl
+import torch
+
+from attention_diffusion import SingleHeadGATLayer, GATLayer
+
+
+def tiny_graph(dim=8, num_nodes=6, num_rels=3):
+    # a fixed graph with a self loop, parallel edges and an isolated node, relation ids and their embeddings
+    torch.manual_seed(0)
+    src = torch.tensor([0, 0, 1, 2, 2, 3, 3, 4, 4])
+    dst = torch.tensor([1, 1, 2, 0, 3, 3, 4, 0, 2])
+    g = dgl.graph((src, dst), num_nodes=num_nodes)
+    rel_emb = torch.randn(num_rels, dim, dtype=torch.float64)
+    g.edata['rel'] = torch.tensor([0, 1, 2, 0, 1, 2, 0, 1, 2])
+    g.edata['emb'] = rel_emb[g.edata['rel']]
+    return g, torch.randn(num_nodes, dim, dtype=torch.float64), rel_emb
+
+
+def concat_logits(layer, g, features):
+    # the reference: SingleHeadGATLayer.edge_attention over the concatenated [src, emb, dst]
+    with g.local_scope():
+        g.ndata['feat'] = features
+        g.apply_edges(layer.edge_attention)
+        return g.edata['e']
+
+
+def test_decomposed_logits_match_concat():
+    g, features, rel_emb = tiny_graph()
+    layer = SingleHeadGATLayer(8, 8, 2, 0.5).double()
+    expected = concat_logits(layer, g, features)
+    with g.local_scope():
+        assert torch.allclose(layer.attention(g, features), expected)
+    with g.local_scope():
+        assert torch.allclose(layer.attention(g, features, rel_emb), expected)
+
+
+def test_fused_head_logits_match_concat():
+    g, features, rel_emb = tiny_graph()
+    fused = GATLayer(8, 8, 2, 0.5, 3).double()
+    with g.local_scope():
+        got = fused.attention(g, features.unsqueeze(1).expand(-1, 3, -1), rel_emb)
+    for i in range(3):
+        head = SingleHeadGATLayer(8, 8, 2, 0.5).double()
+        head.attn_fc.weight.data.copy_(fused.attn_weight[i:i + 1])
+        head.attn_fc.bias.data.copy_(fused.attn_bias[i:i + 1])
+        assert torch.allclose(got[:, i], concat_logits(head, g, features).squeeze(-1))
@@ -0,0 +1,376 @@
+import os
+import glob
+import shutil
+import hashlib
+from collections import defaultdict
+
+import numpy as np
+
+# (event, P793 significant event, Q1190554 occurrence) facts carry the time of an event
+EVENT_REL = 'P793'
+EVENT_OBJ = 'Q1190554'
+
+SUB, REL, OBJ, START, END = range(5)
+
+# bump whenever the arrays written by build_tkg_index change
+CACHE_VERSION = 4
+CACHE_DIR = 'saved_pkl/tkg_cache'
+# approximate peak memory of building an index or a graph from it, in bytes, see --memory_budget
+MEMORY_BUDGET = 1 << 30
+
+
+def budget_rows(memory_budget=None):
+    # facts handled at a time under memory_budget bytes, MEMORY_BUDGET if None
+    return max((memory_budget or MEMORY_BUDGET) // 64, 1 << 12)
+
+
+def _lookup(names, name):
+    # names is sorted, so the vocabulary needs no python dict
+    i = np.searchsorted(names, name)
+    if i < len(names) and names[i] == name:
+        return int(i)
+    return -1
+
+
+def _read_blocks(kg_file, block_bytes):
+    # (n, 5) arrays of byte string fields, parsed block_bytes of the file at a time
+    with open(kg_file, 'rb') as f:
+        rest = b''
+        for block in iter(lambda: f.read(block_bytes), b''):
+            block = rest + block
+            cut = block.rfind(b'\n') + 1
+            rest = block[cut:]
+            if cut > 0:
+                yield _parse_block(block[:cut], kg_file)
+        if rest.strip():
+            yield _parse_block(rest, kg_file)
+
+
+def _parse_block(text, kg_file):
+    # fields are tab separated, names may contain spaces
+    rows = [line.strip().split(b'\t') for line in text.strip().split(b'\n')]
+    assert all(len(row) == 5 for row in rows), 'expected 5 tab separated columns in %s' % kg_file
+    return np.array(rows)
+
+
+def _write_csr(path, name, num_keys, entries, rows, order_by=None):
+    """
+    Counting sort of (key, fact id) entries into <name>_ptr/<name>_facts on disk, `rows` entries at a time.
+    entries() yields (keys, fact_ids) chunks in fact id order, so every segment comes out sorted by fact id.
+    order_by(fact_ids) optionally gives lexsort keys to reorder each segment by; segments are
+    sorted in groups of at most `rows` entries, except that a single larger segment is sorted as a whole.
+    """
+    counts = np.zeros(num_keys, dtype=np.int64)
+    for keys, _ in entries():
+        counts += np.bincount(keys, minlength=num_keys)
+    ptr = np.zeros(num_keys + 1, dtype=np.int64)
+    np.cumsum(counts, out=ptr[1:])
+    np.save(os.path.join(path, name + '_ptr.npy'), ptr)
+
+    out = np.lib.format.open_memmap(os.path.join(path, name + '_facts.npy'), mode='w+',
+                                    dtype=np.int64, shape=(int(ptr[-1]),))
+    cursor = ptr[:-1].copy()
+    for keys, ids in entries():
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        rank = np.arange(len(keys)) - np.searchsorted(keys, keys)
+        out[cursor[keys] + rank] = ids[order]
+        cursor += np.bincount(keys, minlength=num_keys)
+
+    if order_by is not None:
+        first = 0
+        while first < num_keys:
+            last = max(int(np.searchsorted(ptr, ptr[first] + rows, side='right')) - 1, first + 1)
+            last = min(last, num_keys)
+            lo, hi = ptr[first], ptr[last]
+            ids = np.array(out[lo:hi])
+            segments = np.repeat(np.arange(first, last), np.diff(ptr[first:last + 1]))
+            out[lo:hi] = ids[np.lexsort(tuple(order_by(ids)) + (segments,))]
+            first = last
+    out.flush()
+    return ptr, out
+
+
+def build_tkg_index(kg_file, path, memory_budget=None):
+    """
+    Stream kg_file into the index arrays under path. The file is read in blocks and every index is
+    built by an on-disk counting sort, so apart from the vocabularies and per-entity counters the peak
+    memory stays around memory_budget bytes whatever the size of the TKG.
+    """
+    block_bytes = max((memory_budget or MEMORY_BUDGET) // 32, 1 << 16)
+    rows = budget_rows(memory_budget)
+    os.makedirs(path)
+
+    # pass 1: sorted vocabularies
+    ent_names = rel_names = None
+    num_facts = 0
+    for fields in _read_blocks(kg_file, block_bytes):
+        ents, rels = np.unique(fields[:, [SUB, OBJ]]), np.unique(fields[:, REL])
+        ent_names = ents if ent_names is None else np.union1d(ent_names, ents)
+        rel_names = rels if rel_names is None else np.union1d(rel_names, rels)
+        num_facts += len(fields)
+    assert num_facts > 0, 'no facts in %s' % kg_file
+    np.save(os.path.join(path, 'ent_names.npy'), np.char.decode(ent_names, 'utf-8'))
+    np.save(os.path.join(path, 'rel_names.npy'), np.char.decode(rel_names, 'utf-8'))
+    num_ent = len(ent_names)
+
+    # pass 2: integer fact table
+    facts = np.lib.format.open_memmap(os.path.join(path, 'facts.npy'), mode='w+',
+                                      dtype=np.int32, shape=(num_facts, 5))
+    i = 0
+    for fields in _read_blocks(kg_file, block_bytes):
+        block = facts[i:i + len(fields)]
+        block[:, SUB] = np.searchsorted(ent_names, fields[:, SUB])
+        block[:, REL] = np.searchsorted(rel_names, fields[:, REL])
+        block[:, OBJ] = np.searchsorted(ent_names, fields[:, OBJ])
+        block[:, START] = fields[:, START].astype(np.int32)
+        block[:, END] = fields[:, END].astype(np.int32)
+        i += len(fields)
+    facts.flush()
+
+    def chunks():
+        for lo in range(0, num_facts, rows):
+            yield np.arange(lo, min(lo + rows, num_facts)), np.array(facts[lo:lo + rows])
+
+    # entity -> facts, a self loop is only listed once
+    def ent_entries():
+        for ids, chunk in chunks():
+            other = chunk[:, SUB] != chunk[:, OBJ]
+            yield np.concatenate([chunk[:, SUB], chunk[other, OBJ]]), np.concatenate([ids, ids[other]])
+    _, ent_facts = _write_csr(path, 'ent', num_ent, ent_entries, rows,
+                              order_by=lambda ids: (ids, facts[ids, START]))
+    _, ent_end_facts = _write_csr(path, 'ent_end', num_ent, ent_entries, rows,
+                                  order_by=lambda ids: (ids, facts[ids, END]))
+    for name, seg, column in (('ent_starts', ent_facts, START), ('ent_ends', ent_end_facts, END)):
+        times = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+',
+                                          dtype=np.int32, shape=seg.shape)
+        for lo in range(0, len(seg), rows):
+            times[lo:lo + rows] = facts[seg[lo:lo + rows], column]
+        times.flush()
+
+    # subject -> facts sorted by object
+    def pair_entries():
+        for ids, chunk in chunks():
+            yield chunk[:, SUB], ids
+    _write_csr(path, 'pair', num_ent, pair_entries, rows, order_by=lambda ids: (ids, facts[ids, OBJ]))
+
+    # relation -> facts sorted by (subject, object), the per-relation adjacency the graph is built from
+    def rel_entries():
+        for ids, chunk in chunks():
+            yield chunk[:, REL], ids
+    _write_csr(path, 'rel', len(rel_names), rel_entries, rows,
+               order_by=lambda ids: (ids, facts[ids, OBJ], facts[ids, SUB]))
+
+    # event -> occurrence facts
+    rel_id, obj_id = _lookup(rel_names, EVENT_REL.encode()), _lookup(ent_names, EVENT_OBJ.encode())
+
+    def event_entries():
+        for ids, chunk in chunks():
+            is_event = (chunk[:, REL] == rel_id) & (chunk[:, OBJ] == obj_id)
+            yield chunk[is_event, SUB], ids[is_event]
+    _write_csr(path, 'event', num_ent, event_entries, rows)
+
+
+class TKGIndex(object):
+    """
+    Integer-encoded TKG: one (sub, rel, obj, start, end) row per fact plus CSR lookup indexes.
+    Every index is a pair of arrays `<name>_ptr` (num_keys + 1 offsets) and `<name>_facts`
+    (fact ids grouped by key), so the facts of key x are facts[x_facts[x_ptr[x]:x_ptr[x + 1]]].
+      ent:   facts where the entity is subject or object, sorted by start time, with their starts
+             in ent_starts
+      ent_end: the same facts sorted by end time, with their ends in ent_ends. The two orders are
+             the interval index of the entity
+      pair:  facts by subject, sorted by object (for (head, tail) lookups)
+      rel:   facts by relation, sorted by (subject, object), see construct_graph.index_adjacency
+      event: occurrence facts of events, by subject
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        for name, value in arrays.items():
+            setattr(self, name, value)
+        self.num_entities = len(self.ent_names)
+        self.num_facts = len(self.facts)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        arrays = {}
+        for f in sorted(os.listdir(path)):
+            arrays[f[:-len('.npy')]] = np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+        return cls(arrays)
+
+    def entity_id(self, name):
+        return _lookup(self.ent_names, name)
+
+    def segment(self, index, e):
+        ptr = self.arrays[index + '_ptr']
+        return self.arrays[index + '_facts'][ptr[e]:ptr[e + 1]]
+
+    def entity(self, e):
+        return self.segment('ent', e)
+
+    def pair(self, head, tail):
+        seg = self.segment('pair', head)
+        objs = self.facts[seg, OBJ]
+        lo, hi = np.searchsorted(objs, tail), np.searchsorted(objs, tail, side='right')
+        return seg[lo:hi]
+
+    def _between(self, e, a, b, by_end=False):
+        # facts of e with a <= start <= b, or a <= end <= b by_end, found by bisecting the sorted segment
+        lo, hi = self.ent_ptr[e], self.ent_ptr[e + 1]
+        times = (self.ent_ends if by_end else self.ent_starts)[lo:hi]
+        i = np.searchsorted(times, a) if a is not None else 0
+        j = np.searchsorted(times, b, side='right') if b is not None else len(times)
+        return (self.ent_end_facts if by_end else self.ent_facts)[lo + i:lo + j]
+
+    def overlapping(self, e, a, b):
+        # facts of e valid at some point of [a, b], i.e. start <= b and end >= a. Of the two candidate
+        # runs, facts starting by b and facts ending from a, the shorter one is filtered: it holds the k
+        # answers plus the facts over before a or the ones starting after b, whichever are fewer
+        if a is None or b is None:
+            return self._between(e, None, b) if a is None else self._between(e, a, None, by_end=True)
+        lo, hi = self.ent_ptr[e], self.ent_ptr[e + 1]
+        started = np.searchsorted(self.ent_starts[lo:hi], b, side='right')
+        ending = hi - lo - np.searchsorted(self.ent_ends[lo:hi], a)
+        if started <= ending:
+            ids = self.ent_facts[lo:lo + started]
+            return ids[self.facts[ids, END] >= a]
+        ids = self.ent_end_facts[hi - ending:hi]
+        return ids[self.facts[ids, START] <= b]
+
+    def within(self, e, a, b):
+        # facts of e that start and end inside [a, b]
+        ids = self._between(e, a, b)
+        return ids if b is None else ids[self.facts[ids, END] <= b]
+
+    def at_time(self, e, t):
+        # facts of e that start or end at t, a bisect in each order
+        return np.union1d(self._between(e, t, t), self._between(e, t, t, by_end=True))
+
+    def event(self, e):
+        return self.segment('event', e)
+
+    def to_tuples(self, fact_ids):
+        # back to the (sub, rel, obj, start, end) string tuples the question annotations use
+        rows = self.facts[fact_ids]
+        return set(zip(self.ent_names[rows[:, SUB]].tolist(), self.rel_names[rows[:, REL]].tolist(),
+                       self.ent_names[rows[:, OBJ]].tolist(), rows[:, START].astype(str).tolist(),
+                       rows[:, END].astype(str).tolist()))
+
+
+class _FactView(object):
+    # read-only stand-in for the defaultdict(set) lookups, built on access
+    def __init__(self, index):
+        self.index = index
+
+    def __contains__(self, key):
+        return len(self[key]) > 0
+
+    def get(self, key, default=None):
+        facts = self[key]
+        return facts if len(facts) > 0 else default
+
+
+class Ent2TripletView(_FactView):
+    def __getitem__(self, ent):
+        e = self.index.entity_id(ent)
+        return self.index.to_tuples(self.index.entity(e)) if e >= 0 else set()
+
+
+class Ents2RelTimeView(_FactView):
+    def __getitem__(self, key):
+        head, tail = self.index.entity_id(key[0]), self.index.entity_id(key[1])
+        if head < 0 or tail < 0:
+            return set()
+        return self.index.to_tuples(self.index.pair(head, tail))
+
+
+class EntTime2RelEntView(_FactView):
+    def __getitem__(self, ent):
+        by_time = defaultdict(set)
+        e = self.index.entity_id(ent)
+        if e < 0:
+            return by_time
+        ids = self.index.entity(e)
+        rows = self.index.facts[ids]
+        for t in np.unique(rows[:, [START, END]]):
+            by_time[int(t)] = self.index.to_tuples(ids[(rows[:, START] == t) | (rows[:, END] == t)])
+        return by_time
+
+    def at(self, ent, t):
+        e = self.index.entity_id(ent)
+        return self.index.to_tuples(self.index.at_time(e, t)) if e >= 0 else set()
+
+    def within(self, ent, a=None, b=None):
+        # list ordered by start time, so sampling from it does not depend on set ordering
+        e = self.index.entity_id(ent)
+        if e < 0:
+            return []
+        ids = self.index.within(e, a, b)
+        return sorted(self.index.to_tuples(ids), key=lambda f: (int(f[3]), f))
+
+
+class Event2TimeView(_FactView):
+    def __getitem__(self, event):
+        e = self.index.entity_id(event)
+        return self.index.to_tuples(self.index.event(e)) if e >= 0 else set()
+
+
+_hashes = {}
+
+
+def file_hash(path, block_size=1 << 24):
+    # content hash, computed once per process unless the file changes
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                h.update(block)
+        _hashes[key] = h.hexdigest()
+    return _hashes[key]
+
+
+def cache_stem(kg_file, cache_dir=CACHE_DIR):
+    # full.txt exists once per dataset, so the stem also tells the files apart by location
+    location = hashlib.sha1(os.path.abspath(kg_file).encode()).hexdigest()[:8]
+    return os.path.join(cache_dir, '%s-%s' % (os.path.basename(kg_file), location))
+
+
+def cache_path(kg_file, cache_dir=CACHE_DIR):
+    return '%s-v%d-%s' % (cache_stem(kg_file, cache_dir), CACHE_VERSION, file_hash(kg_file)[:16])
+
+
+_loaded = {}
+
+
+def load_tkg_index(kg_file, cache_dir=CACHE_DIR, memory_budget=None):
+    """
+    Index of kg_file, built on first use and cached under cache_dir by content hash and format version.
+    The arrays are memory mapped, so every call site and DataLoader worker shares one copy of them.
+    """
+    key = os.path.abspath(kg_file)
+    if key in _loaded:
+        return _loaded[key]
+    path = cache_path(kg_file, cache_dir)
+    if not os.path.isdir(path):
+        print('Building TKG index for', kg_file)
+        # build in a scratch directory so a crashed build never leaves a half cache behind
+        tmp = path + '.tmp%d' % os.getpid()
+        try:
+            build_tkg_index(kg_file, tmp, memory_budget)
+            os.rename(tmp, path)
+        except OSError:
+            # another process finished the same cache first
+            if not os.path.isdir(path):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        # indexes of older versions or contents of this file are stale now
+        for stale in glob.glob(glob.escape(cache_stem(kg_file, cache_dir)) + '-v*'):
+            if stale != path and '.tmp' not in stale:
+                shutil.rmtree(stale, ignore_errors=True)
+    print('Loading TKG index from', path)
+    _loaded[key] = TKGIndex.load(path)
+    return _loaded[key]
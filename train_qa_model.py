@@ -7,10 +7,13 @@ import pickle
 import numpy as np
 from qa_baselines import QA_baseline, QA_lm, QA_embedkgqa, QA_cronkgqa
 from qa_sub import QA_Sub
+from subgraphs import SubgraphCache, SubgraphTelemetry
 from qa_datasets import QA_Dataset, QA_Dataset_Sub, QA_Dataset_Baseline
 from torch.utils.data import Dataset, DataLoader
 import utils
+import tkg_index
 from tqdm import tqdm
+from hard_supervision_functions import get_ents2reltime, get_event2time, get_ent2triplet
 from utils import loadTkbcModel, loadTkbcModel_complex, print_info, get_neighbours, check_triples, rerank_ba,rerank_fl, rerank_st, rerank_tj
 from collections import defaultdict
 from datetime import datetime
@@ -40,6 +43,50 @@ parser.add_argument(
     action="store_true"
 )
 
+parser.add_argument(
+    '--subgraph_module',
+    help="encode the question subgraphs with the GAT, costs subgraph extraction in every batch",
+    action="store_true"
+)
+
+parser.add_argument(
+    '--attention_once',
+    help="experimental: compute the GAT attention once per layer and reuse it for all diffusion steps. Changes "
+         "the model for k > 1 and its Hits@1/Hits@10 have not been compared with the default yet; the GAT "
+         "forward+backward is 1.2-1.4x faster, not k times",
+    action="store_true"
+)
+
+parser.add_argument(
+    '--gat_backend', default='dgl', choices=['dgl', 'torch'],
+    help="message passing of the GAT, torch runs it without DGL kernels. Only GATNet drops DGL, the "
+         "QA model still builds its subgraphs and readout with DGL"
+)
+
+parser.add_argument(
+    '--whole_graph_eval',
+    help="evaluate with the GAT run once over the whole graph instead of over every question subgraph. An "
+         "approximation: nodes also receive messages from outside the question subgraph, so the scores differ "
+         "from those of training and of the default evaluation",
+    action="store_true"
+)
+
+parser.add_argument(
+    '--graph_chunk_size', default=65536, type=int,
+    help="nodes whose in-edges are processed at a time by --whole_graph_eval"
+)
+
+parser.add_argument(
+    '--score_chunk_size', default=0, type=int,
+    help="score answers this many entities at a time in evaluation, keeping only the top ones; 0 scores all at once"
+)
+
+parser.add_argument(
+    '--checkpoint_activations',
+    help="recompute the activations of the GAT and transformer layers in backward, for larger batches and khop",
+    action="store_true"
+)
+
 parser.add_argument(
     '--time_sensitivity',
     help="whether use time sensitivity module",
@@ -57,6 +104,65 @@ parser.add_argument(
     help="khop subgraph extracted by kg"
 )
 
+parser.add_argument(
+    '--khop_index',
+    help="precompute the khop subgraphs of question entities instead of a BFS per forward",
+    action="store_true"
+)
+
+parser.add_argument(
+    '--subgraph_sampling', default=None, choices=['uniform', 'relation', 'temporal'],
+    help="sample question subgraphs with a fan-out cap per hop instead of taking the full khop neighbourhood"
+)
+
+parser.add_argument(
+    '--fanout', default=20, type=int,
+    help="out-edges followed per node and hop when sampling subgraphs"
+)
+
+parser.add_argument(
+    '--node_budget', default=2000, type=int,
+    help="max nodes of a sampled subgraph"
+)
+
+parser.add_argument(
+    '--sampling_seed', default=0, type=int,
+    help="seed of subgraph sampling"
+)
+
+parser.add_argument(
+    '--time_scope',
+    help="only follow subgraph edges whose facts overlap the question's time window",
+    action="store_true"
+)
+
+parser.add_argument(
+    '--time_margin', default=0, type=int,
+    help="years the question's time window is widened by for time-scoped subgraphs"
+)
+
+parser.add_argument(
+    '--union_subgraph',
+    help="run the GAT once over the union of the question subgraphs of a batch",
+    action="store_true"
+)
+
+parser.add_argument(
+    '--subgraph_log', default='', type=str,
+    help="JSONL file for per-question subgraph sizes and timings, summarize it with subgraph_report.py"
+)
+
+parser.add_argument(
+    '--subgraph_log_every', default=100, type=int,
+    help="batches between the histogram summaries of --subgraph_log"
+)
+
+parser.add_argument(
+    '--subgraph_cache_size', default=0, type=int,
+    help="nodes+edges of question subgraphs kept in a cache in shared memory, used by the train and test splits "
+         "and all loader workers. 0 disables it"
+)
+
 parser.add_argument(
     '--dataset_name', default='wikidata_big', type=str,
     help="Which dataset."
@@ -149,15 +255,31 @@ parser.add_argument(
     help="Test data."
 )
 
+parser.add_argument(
+    '--prep_workers', default=1, type=int,
+    help="Processes for hard supervision and dataset preparation."
+)
+
+parser.add_argument(
+    '--prep_seed', default=0, type=int,
+    help="Seed for the fact sampling of hard supervision."
+)
+
+parser.add_argument(
+    '--memory_budget', default=1024, type=int,
+    help="Approximate peak memory in MB of building the TKG index and the graph."
+)
+
 args = parser.parse_args()
 print_info(args)
+tkg_index.MEMORY_BUDGET = args.memory_budget << 20
 
-with open('./LGQA/saved_pkl/e2rt.pkl', 'rb') as f:
-    e2rt = pickle.load(f)
-with open('./LGQA/saved_pkl/event2time.pkl', 'rb') as f:
-    event2time = pickle.load(f)
-with open('./LGQA/saved_pkl/e2tr.pkl', 'rb') as f:
-    e2tr = pickle.load(f)
+# views over the memory mapped TKG index, shared with the datasets and their workers
+kg_file = 'data/{dataset_name}/kg/{tkg_file}'.format(dataset_name=args.dataset_name, tkg_file=args.tkg_file)
+e2rt = get_ents2reltime(kg_file)
+event2time = get_event2time(kg_file)
+e2tr = get_ent2triplet(kg_file)
+utils.load_kg_lookups(kg_file)
 
 
 def eval(qa_model, dataset, batch_size=128, split='valid', k=200, subgraph_reasoning=False):
@@ -173,22 +295,49 @@ def eval(qa_model, dataset, batch_size=128, split='valid', k=200, subgraph_reaso
     print('Evaluating split', split)
 
     data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
-                             num_workers=num_workers, collate_fn=dataset._collate_fn)
+                             num_workers=num_workers, collate_fn=dataset._collate_fn, pin_memory=True)
     topk_answers = []
     total_loss = 0
+    subgraph_size, subgraph_copies = 0, 0
+    telemetry = getattr(qa_model, 'telemetry', None)
+    if telemetry is not None:
+        telemetry.tag = split
+    whole_graph = getattr(qa_model, 'whole_graph_eval', False) and dataset.subgraph_module
+    if whole_graph:
+        print('Warning: --whole_graph_eval approximates the per-question subgraph GAT, nodes also aggregate '
+              'neighbours outside the subgraph')
+        start = datetime.now()
+        qa_model.cache_graph(dataset.dgl_graph)
+        eval_log.append('Whole-graph GAT over %d nodes in %.1fs' % (dataset.dgl_graph.num_nodes(),
+                                                                        (datetime.now() - start).total_seconds()))
     loader = tqdm(data_loader, total=len(data_loader), unit="batches")
     for i_batch, a in enumerate(loader):
         if i_batch * batch_size == len(dataset.data):
             break
-        answers_khot = a[-2]  # last one assumed to be target
-        scores = qa_model.forward(a, dataset.dgl_graph)
-        for s in scores:
-            pred = dataset.getAnswersFromScores(s, k=max_k)
-            topk_answers.append(pred)
-        loss = qa_model.loss(scores, answers_khot.cuda())
+        answers_khot = a[12]
+        if a[14] is not None:
+            subgraph_size += a[14].size
+            subgraph_copies += a[14].copies
+        if getattr(qa_model, 'score_chunk_size', 0):
+            _, ids, loss = qa_model.forward_topk(a, max_k)
+            topk_answers.extend(dataset.getAnswersFromIds(row) for row in ids)
+        else:
+            scores = qa_model.forward(a)
+            for s in scores:
+                pred = dataset.getAnswersFromScores(s, k=max_k)
+                topk_answers.append(pred)
+            loss = qa_model.loss(scores, answers_khot.cuda())
         total_loss += loss.item()
+    if telemetry is not None:
+        telemetry.flush()
+    if whole_graph:
+        qa_model.node_cache = None
     eval_log.append('Loss %f' % total_loss)
     eval_log.append('Eval batch size %d' % batch_size)
+    if dataset.subgraph_cache is not None:
+        eval_log.append(dataset.subgraph_cache.stats())
+    if dataset.subgraph_module and dataset.union_subgraph:
+        eval_log.append(union_subgraph_stats(subgraph_size, subgraph_copies))
 
     # do eval for each k in k_list
     # want multiple hit@k
@@ -295,6 +444,11 @@ def eval(qa_model, dataset, batch_size=128, split='valid', k=200, subgraph_reaso
 
 
 
+def union_subgraph_stats(size, copies):
+    return 'union subgraphs: %d nodes+edges instead of %d in per-question copies (%.2fx duplication removed)' % (
+        size, copies, copies / max(1, size))
+
+
 def append_log_to_file(eval_log, epoch, filename):
     f = open(filename, 'a+')
     now = datetime.now()
@@ -313,7 +467,7 @@ def train(qa_model, dataset, valid_dataset, args, result_filename=None):
     optimizer.zero_grad()
     batch_size = args.batch_size
     data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
-                             collate_fn=dataset._collate_fn)
+                             collate_fn=dataset._collate_fn, pin_memory=True)
     max_eval_score = 0
     if args.save_to == '':
         args.save_to = 'gtr'
@@ -342,6 +496,7 @@ def train(qa_model, dataset, valid_dataset, args, result_filename=None):
         f.close()
 
     max_eval_score = 0.
+    telemetry = getattr(qa_model, 'telemetry', None)
 
     print('Starting training')
     for epoch in range(args.max_epochs):
@@ -349,11 +504,17 @@ def train(qa_model, dataset, valid_dataset, args, result_filename=None):
         epoch_loss = 0
         loader = tqdm(data_loader, total=len(data_loader), unit="batches")
         running_loss = 0
+        subgraph_size, subgraph_copies = 0, 0
+        if telemetry is not None:
+            telemetry.tag = 'train %d' % epoch
         for i_batch, a in enumerate(loader):
             qa_model.zero_grad()
 
-            answers_khot = a[-2]  # last one assumed to be target
-            scores = qa_model.forward(a, dataset.dgl_graph)
+            answers_khot = a[12]
+            if a[14] is not None:
+                subgraph_size += a[14].size
+                subgraph_copies += a[14].copies
+            scores = qa_model.forward(a)
 
             loss = qa_model.loss(scores, answers_khot.cuda())
             loss.backward()
@@ -365,6 +526,12 @@ def train(qa_model, dataset, valid_dataset, args, result_filename=None):
             loader.update()
 
         print('Epoch loss = ', epoch_loss)
+        if telemetry is not None:
+            telemetry.flush()
+        if dataset.subgraph_cache is not None:
+            print(dataset.subgraph_cache.stats())
+        if dataset.subgraph_module and dataset.union_subgraph:
+            print(union_subgraph_stats(subgraph_size, subgraph_copies))
         if (epoch + 1) % args.valid_freq == 0:
             print('Starting eval')
             eval_score, eval_log = eval(qa_model, valid_dataset, batch_size=args.valid_batch_size,
@@ -424,10 +591,13 @@ elif args.model == 'cronkgqa' and args.supervision != 'hard':
     test_dataset = QA_Dataset_Baseline(split=test, dataset_name=args.dataset_name)
 elif args.model == 'sub':  # supervised models
     qa_model = QA_Sub(tkbc_model, args)
+    subgraph_cache = SubgraphCache(args.subgraph_cache_size) if args.subgraph_cache_size > 0 else None
     if args.mode == 'train':
-        dataset = QA_Dataset_Sub(split=train_split, dataset_name=args.dataset_name, args=args, tkbc_model=tkbc_model)
+        dataset = QA_Dataset_Sub(split=train_split, dataset_name=args.dataset_name, args=args, tkbc_model=tkbc_model,
+                                 subgraph_cache=subgraph_cache)
     # valid_dataset = QA_Dataset_TempoQR(split=args.eval_split, dataset_name=args.dataset_name, args=args)
-    test_dataset = QA_Dataset_Sub(split=test, dataset_name=args.dataset_name, args=args, tkbc_model=tkbc_model)
+    test_dataset = QA_Dataset_Sub(split=test, dataset_name=args.dataset_name, args=args, tkbc_model=tkbc_model,
+                                  subgraph_cache=subgraph_cache)
 
 else:
     print('Model %s not implemented!' % args.model)
@@ -469,6 +639,8 @@ else:
     print('Not loading from checkpoint. Starting fresh!')
 
 qa_model = qa_model.cuda()
+if args.subgraph_log != '' and args.subgraph_module:
+    qa_model.telemetry = SubgraphTelemetry(args.subgraph_log, args.subgraph_log_every)
 
 if args.mode == 'eval':
     score, log = eval(qa_model, test_dataset, batch_size=args.valid_batch_size, split=args.eval_split, k=args.eval_k,subgraph_reasoning = args.subgraph_reasoning)
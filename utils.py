@@ -3,6 +3,7 @@ import random
 import torch
 import numpy as np
 from tcomplex import TComplEx
+from hard_supervision_functions import get_ents2reltime, get_event2time, get_ent2triplet
 
 from tqdm import tqdm
 
@@ -245,12 +246,17 @@ def checkIfTkbcEmbeddingsTrained(tkbc_model, dataset_name, split='test'):
         print(question_type, correct_count, total_count, correct_count / total_count)
 
 
-with open('./SubGTR/saved_pkl/e2rt.pkl', 'rb') as f:
-    e2rt = pickle.load(f)
-with open('./SubGTR/saved_pkl/event2time.pkl', 'rb') as f:
-    event2time = pickle.load(f)
-with open('./SubGTR/saved_pkl/e2tr.pkl', 'rb') as f:
-    e2tr = pickle.load(f)
+# TKG lookups used by the reranking functions below, set by load_kg_lookups
+e2rt = None
+event2time = None
+e2tr = None
+
+
+def load_kg_lookups(kg_file):
+    global e2rt, event2time, e2tr
+    e2rt = get_ents2reltime(kg_file)
+    event2time = get_event2time(kg_file)
+    e2tr = get_ent2triplet(kg_file)
 
 
 def get_neighbours(e):